@@ -2,97 +2,418 @@
 
 from collections import defaultdict
 import json
+import os
+import uuid
 import networkx as nx
-from .db import Movie, Rating, UserLink, init_db
-from .cache import Cache
+import numpy as np
+from . import bitsets
+from .buddies import buddy_index
+from .db import Movie, Rating, KeyValue, db, init_db, fetch_batches
+from .cache import Cache, LRUCache
+from .gatekeepers import users_gatekeepers
+from .graph import BipartiteGraph, ID_DTYPE, RATING_DTYPE, id_rows
+from .listutils import chunks
 
 cache = Cache()
 
-@cache.memoize0()
-def global_ratings_graph():
-    return RatingsGraph()
+# Minimal rating for a rating to be considered positive, i.e. to be an edge of
+# the ratings graph.
+POSITIVE_RATING = 3
+
+# Key of the id of the global ratings graph snapshot in the KeyValue table
+SNAPSHOT_KEY = "analysis.ratings_graph_snapshot"
+
+# New ratings are kept in a side snapshot (see ``ratings_graph_delta``) that's
+# merged with the main one when it's loaded, until they're more than this
+# ratio of its ratings; both are then replaced by a new main snapshot.
+DELTA_MAX_RATIO = 0.05
+
+# Default size of the ego graphs cache of each ratings graph, in bytes
+EGO_CACHE_BYTES = 64 * 2**20
+
+# Number of ego graphs computed at once by default
+EGO_BATCH_SIZE = 32
+
+# ``BipartiteGraph`` of all the ratings of the dataset, loaded once by the
+# current process
+_global_ratings_graph = None
+
+# Global ratings graphs of the current process, by threshold. They're views
+# over ``_global_ratings_graph``.
+_global_graphs = {}
 
 @cache.memoize0()
 def movies_genres_distribution():
     return Movie.genres_distribution()
 
+def ratings_graph_snapshot():
+    """
+    Return the filename of the snapshot of the global ratings graph. It's
+    next to the DB.
+    """
+    return "%s.graph" % db.database
+
+def ratings_graph_delta():
+    """
+    Return the filename of the snapshot of the ratings added to the global
+    ratings graph since its snapshot was made. It's next to the DB.
+    """
+    return "%s.graph.delta" % db.database
+
+def global_ratings_graph(min_rating=POSITIVE_RATING):
+    """
+    Return the ratings graph of the whole dataset with the ratings of at least
+    ``min_rating``, or all of them if it's ``None``. All the ratings are
+    loaded once from a snapshot file (see ``ratings_graph_snapshot``) that
+    other calls, including in other processes, memory-map; each threshold is
+    a view over them. The snapshot is created from the DB if needed.
+    """
+    if min_rating not in _global_graphs:
+        _global_graphs[min_rating] = RatingsGraph(
+                _global_ratings().at_least(min_rating))
+    return _global_graphs[min_rating]
+
+def update_global_ratings_graph(ratings):
+    """
+    Add new ``(u_id, m_id, rating)`` ratings to the cached global ratings
+    graph and return its view at ``POSITIVE_RATING``. If the graph is not
+    cached yet it's computed from the DB, which is assumed to already contain
+    these ratings.
+
+    The main snapshot is not rewritten: the new ratings are added to the side
+    snapshot of ``ratings_graph_delta``, which is small, and merged with the
+    main one with ``BipartiteGraph.add_edges``. This copies the arrays of the
+    graph, in a time linear in its number of ratings, but doesn't sort them
+    again. Once the side snapshot has more than ``DELTA_MAX_RATIO`` of the
+    ratings both are replaced by a new main snapshot. The threshold views
+    that were loaded are rebuilt on the new graph.
+    """
+    global _global_ratings_graph
+
+    snapshot = _load_snapshot()
+    thresholds = list(_global_graphs)
+    _global_ratings_graph = None
+    _global_graphs.clear()
+    if snapshot is None:
+        return global_ratings_graph()
+
+    graph, snapshot_id = snapshot
+    ratings = list(ratings)
+    users = np.array([node_id(u) for u, _, _ in ratings], dtype=ID_DTYPE)
+    movies = np.array([node_id(m) for _, m, _ in ratings], dtype=ID_DTYPE)
+    ratings = np.array([r for _, _, r in ratings], dtype=RATING_DTYPE)
+
+    delta = _load_delta(snapshot_id)
+    if delta is not None:
+        old_users, old_movies, old_ratings = delta.edges()
+        users = np.concatenate((old_users, users))
+        movies = np.concatenate((old_movies, movies))
+        ratings = np.concatenate((old_ratings, ratings))
+    delta = BipartiteGraph.from_edges(users, movies, ratings)
+
+    graph = graph.add_edges(*delta.edges())
+    if len(delta.user_idx) > DELTA_MAX_RATIO * len(graph.user_idx):
+        graph = _save_global_ratings(graph)
+    else:
+        delta.save(ratings_graph_delta(), snapshot_id)
+
+    _global_ratings_graph = graph
+    for min_rating in thresholds:
+        global_ratings_graph(min_rating)
+    return global_ratings_graph()
+
+def _global_ratings():
+    """
+    Return the ``BipartiteGraph`` of all the ratings of the dataset.
+    """
+    global _global_ratings_graph
+
+    if _global_ratings_graph is None:
+        graph = _load_global_ratings()
+        if graph is None:
+            graph = _save_global_ratings(
+                    BipartiteGraph.from_edges(*ratings_edges()))
+        _global_ratings_graph = graph
+    return _global_ratings_graph
+
+def _load_global_ratings():
+    """
+    Load the snapshot of the global ratings graph and add the ratings of its
+    side snapshot, if any. Return ``None`` if there's none or if it was made
+    for another DB.
+    """
+    snapshot = _load_snapshot()
+    if snapshot is None:
+        return None
+
+    graph, snapshot_id = snapshot
+    delta = _load_delta(snapshot_id)
+    if delta is not None:
+        graph = graph.add_edges(*delta.edges())
+    return graph
+
+def _load_snapshot():
+    """
+    Load the main snapshot of the global ratings graph and return a
+    ``(graph, snapshot_id)`` pair, or ``None`` if there's none or if it was
+    made for another DB.
+    """
+    snapshot_id = KeyValue.get_key(SNAPSHOT_KEY)
+    if snapshot_id is None:
+        return None
+
+    try:
+        graph, meta = BipartiteGraph.load(ratings_graph_snapshot())
+    except (IOError, ValueError):
+        return None
+
+    if meta != snapshot_id:
+        return None
+    return graph, snapshot_id
+
+def _load_delta(snapshot_id):
+    """
+    Load the side snapshot of the ratings added to the main one with the id
+    ``snapshot_id``. Return ``None`` if there's none or if it was made for
+    another one.
+    """
+    try:
+        graph, meta = BipartiteGraph.load(ratings_graph_delta())
+    except (IOError, ValueError):
+        return None
+
+    if meta != snapshot_id:
+        return None
+    return graph
+
+def _save_global_ratings(graph):
+    """
+    Save a snapshot of the global ratings graph and return the graph loaded
+    from it. The side snapshot is removed.
+    """
+    # Snapshots have a random id that's stored in the DB as well. This ensures
+    # we don't load one that was made for another DB.
+    snapshot_id = uuid.uuid4().hex
+    graph.save(ratings_graph_snapshot(), snapshot_id)
+    KeyValue.set_key(SNAPSHOT_KEY, snapshot_id)
+    try:
+        os.remove(ratings_graph_delta())
+    except OSError:
+        pass
+    return BipartiteGraph.load(ratings_graph_snapshot())[0]
+
+def ratings_edges(min_rating=None):
+    """
+    Return the ratings of at least ``min_rating`` (default: all of them) as a
+    tuple of ``(users, movies, ratings)`` arrays.
+    """
+    query = Rating.select(Rating.user, Rating.movie, Rating.rating)
+    if min_rating is not None:
+        query = query.where(Rating.rating >= min_rating)
+
+    dtype = [("user", ID_DTYPE), ("movie", ID_DTYPE), ("rating", RATING_DTYPE)]
+    batches = [np.array(rows, dtype=dtype) for rows in fetch_batches(query)]
+    edges = np.concatenate(batches) if batches else np.zeros(0, dtype=dtype)
+    return edges["user"], edges["movie"], edges["rating"]
+
 class RatingsGraph(object):
+    """
+    The bipartite graph of the users and the movies they positively rated.
+
+    Users and movies are identified by strings like ``"u42"`` and ``"m1"``.
+    The graph itself is stored as a compact :class:`BipartiteGraph` in the
+    ``csr`` attribute; use ``to_networkx`` to get a networkx graph.
 
-    def __init__(self, nxgraph=None):
-        if nxgraph is None:
+    Without a ``graph`` all the ratings are loaded from the DB, and the graph
+    is a view of those of at least ``min_rating``. Use ``at_least`` to get
+    views at other thresholds.
+    """
+
+    def __init__(self, graph=None, min_rating=POSITIVE_RATING):
+        if graph is None:
             init_db()
-            nxgraph = nx.Graph()
-            for r in Rating.select().where(Rating.rating>=3):
-                u_id = "u%d" % r.user_id
-                m_id = "m%d" % r.movie_id
+            graph = BipartiteGraph.from_edges(*ratings_edges())
+            graph = graph.at_least(min_rating)
+        elif isinstance(graph, nx.Graph):
+            graph = BipartiteGraph.from_networkx(graph)
+        self.csr = graph
+        self.ego_cache = LRUCache(EGO_CACHE_BYTES)
+        self._keys = {}
+        self._bitsets = {}
+
+    @property
+    def min_rating(self):
+        """
+        Minimal rating of the edges of this graph, or ``None`` if it's not a
+        threshold view.
+        """
+        return self.csr.min_rating
 
-                nxgraph.add_node(u_id, bipartite=1)
-                nxgraph.add_node(m_id, bipartite=0)
-                nxgraph.add_edge(u_id, m_id)
-        self.g = nxgraph
-        self._cache = {}
+    def at_least(self, min_rating):
+        """
+        Return a view of this graph with the ratings of at least
+        ``min_rating``. The view shares the storage of this graph; if this
+        graph is itself a view the threshold can be lower than its own.
+        """
+        return RatingsGraph(self.csr.at_least(min_rating))
+
+    def to_networkx(self):
+        """
+        Return the graph as a networkx graph with ``"u<id>"`` and ``"m<id>"``
+        nodes.
+        """
+        return self.csr.to_networkx()
 
     @classmethod
     def users_buddies(cls, buddy_threshold=0):
         """
-        Return a graph of all users where an edge between two users means they
-        have at least one movie in common. Users that aren't connected to
+        Return the graph of all users where an edge between two users means
+        they have at least one movie in common, as a
+        :class:`~movies.buddies.BuddyGraph`. Users that aren't connected to
         anyone are not present in the resulting graph.
 
-        ``buddy_threshold`` is the minimal score a dyad must have to be kept.
+        ``buddy_threshold`` is the score a dyad must be above to be kept. The
+        links are loaded once; see :func:`~movies.buddies.buddy_index`.
         """
-        g = nx.Graph()
-
-        done = set()
-
-        for link in UserLink.select():
-            for u2, d in link.buddies.items():
-                if d["j"] > buddy_threshold:
-                    u1, u2 = sorted(("u%s" % link.user_id, u2))
-                    if (u1, u2) in done:
-                        continue
-                    done.add((u1, u2))
+        return buddy_index().at_least(buddy_threshold, strict=True)
 
-                    g.add_edge(u1, u2, {"score": d["j"]})
-
-        return g
+    def add_edges(self, edges):
+        """
+        Add ``(u_id, m_id, rating)`` ratings edges to the graph. If it's a
+        threshold view only the ratings above its threshold are visible.
+        Ratings are ignored if the graph doesn't have any.
+        """
+        edges = list(edges)
+        ratings = None
+        if self.csr.user_ratings is not None:
+            ratings = [r for _, _, r in edges]
+        self.csr = self.csr.add_edges([node_id(u) for u, _, _ in edges],
+                [node_id(m) for _, m, _ in edges], ratings)
+        # cached ego graphs, nodes and bitsets are now outdated
+        self.ego_cache.clear()
+        self._keys = {}
+        self._bitsets = {}
 
     def users(self):
         """Return all the users"""
-        return [n for n in self.g.nodes() if n.startswith("u")]
+        return self._node_keys("users", user_keys)
 
     def movies(self):
         """Return all the movies"""
-        return [n for n in self.g.nodes() if n.startswith("m")]
+        return self._node_keys("movies", movie_keys)
+
+    def users_by_degree(self):
+        """
+        Return all the users sorted by decreasing number of movies they
+        positively rated
+        """
+        return self._node_keys("users_by_degree", user_keys)
+
+    def movies_by_degree(self):
+        """
+        Return all the movies sorted by decreasing number of fans
+        """
+        return self._node_keys("movies_by_degree", movie_keys)
+
+    def user_count(self):
+        """Return the number of users"""
+        return len(self.csr.users())
+
+    def movie_count(self):
+        """Return the number of movies"""
+        return len(self.csr.movies())
+
+    def movie_popularity(self, m_id):
+        """
+        Return the popularity of a movie, i.e. the ratio of the users who are
+        fans of it.
+        """
+        i = self.csr.movie_index(node_id(m_id))
+        return float(self.csr.movie_popularities()[i]) if i >= 0 else 0.0
+
+    def movie_inverse_popularity(self, m_id):
+        """
+        Return the inverse popularity of a movie, i.e. the number of users
+        for each one of its fans. For example a movie liked by 1% of the users
+        has an inverse popularity of 100.
+        """
+        popularity = self.movie_popularity(m_id)
+        return 1 / popularity if popularity else float("inf")
+
+    def user_degree(self, u_id):
+        """Return the number of movies positively rated by an user"""
+        return self.csr.user_degree(node_id(u_id))
+
+    def movie_degree(self, m_id):
+        """Return the number of fans of a movie"""
+        return self.csr.movie_degree(node_id(m_id))
 
     def movie_fans(self, m_id):
         """Return the users who positively rated a movie"""
-        return self._neighbours(m_id)
+        return user_keys(self.csr.movie_fans(node_id(m_id)))
 
     def movies_fans(self, m_ids):
         """Return the union of the fans of the given movies."""
-        fans = set()
-        for m_id in m_ids:
-            for u in self.movie_fans(m_id):
-                fans.add(u)
-
-        return list(fans)
+        return user_keys(self.csr.movies_fans([node_id(m) for m in m_ids]))
 
     def user_movies(self, u_id):
         """Return the movies positively rated by an user"""
-        return self._neighbours(u_id)
+        return movie_keys(self.csr.user_movies(node_id(u_id)))
 
     def users_movies(self, u_ids):
         """
         Return the union of the movies positively rated by the given users
         """
-        movies = set()
-        for u_id in u_ids:
-            movies.update(self.user_movies(u_id))
-        return list(movies)
+        return movie_keys(self.csr.users_movies([node_id(u) for u in u_ids]))
+
+    def movie_fans_bitsets(self, m_ids):
+        """
+        Return the fans of each one of the given movies as packed bitsets of
+        users (see :mod:`movies.bitsets`), in a 2D array. Use
+        ``bitset_users`` to get the users of a bitset back.
+        """
+        csr = self.csr
+        return self._node_bitsets("fans", csr.movie_ids, m_ids,
+                lambda: bitsets.pack_rows(csr.movie_start, csr.movie_end,
+                    csr.movie_idx, len(csr.user_ids)))
+
+    def user_movies_bitsets(self, u_ids):
+        """
+        Return the movies of each one of the given users as packed bitsets of
+        movies, in a 2D array. Use ``bitset_movies`` to get the movies of a
+        bitset back.
+        """
+        csr = self.csr
+        return self._node_bitsets("movies", csr.user_ids, u_ids,
+                lambda: bitsets.pack_rows(csr.user_start, csr.user_end,
+                    csr.user_idx, len(csr.movie_ids)))
+
+    def users_bitset(self, u_ids):
+        """
+        Return a packed bitset of the given users, comparable with the ones
+        of ``movie_fans_bitsets``. Unknown users are ignored.
+        """
+        rows, known = id_rows(self.csr.user_ids, node_ids(u_ids))
+        return bitsets.pack(rows[known], len(self.csr.user_ids))
+
+    def movies_bitset(self, m_ids):
+        """
+        Return a packed bitset of the given movies, comparable with the ones
+        of ``user_movies_bitsets``. Unknown movies are ignored.
+        """
+        rows, known = id_rows(self.csr.movie_ids, node_ids(m_ids))
+        return bitsets.pack(rows[known], len(self.csr.movie_ids))
+
+    def bitset_users(self, bits):
+        """Return the users of a packed bitset"""
+        return user_keys(self.csr.user_ids[bitsets.indexes(bits)])
+
+    def bitset_movies(self, bits):
+        """Return the movies of a packed bitset"""
+        return movie_keys(self.csr.movie_ids[bitsets.indexes(bits)])
 
     def ego_graph(self, u_id, distance=1, inverse_popularity_threshold=0,
-            cache=True):
+            cache=True, subgraph=False):
         """
         Return an ego-centered graph of distance ``distance`` for the user
         ``u_id``. The default distance is 1, which means the resulting graph is
@@ -103,55 +424,47 @@ class RatingsGraph(object):
 
         ``inverse_popularity_threshold`` is the minimum inverse popularity we
         use to filter films. If the threshold is high it’ll exclude the most
-        popular films in our dataset.
+        popular films in our dataset. See ``movie_inverse_popularity``.
+
+        The result is an :class:`EgoGraph` with the nodes of the graph; pass
+        ``subgraph=True`` to get the graph itself as a ``RatingsGraph``.
         """
-        # allow simple caching
-        if cache:
-            key = "uid:%s/d:%d/ipt:%d" % (u_id, distance,
-                    inverse_popularity_threshold)
+        ego = self.ego_graphs([u_id], distance=distance,
+                inverse_popularity_threshold=inverse_popularity_threshold,
+                cache=cache)[0]
+        return ego.subgraph() if subgraph else ego
 
-            if key not in self._cache:
-                self._cache[key] = self.ego_graph(u_id,
-                        distance=distance,
-                        inverse_popularity_threshold=inverse_popularity_threshold,
-                        cache=False)
+    def ego_graphs(self, u_ids, distance=1, inverse_popularity_threshold=0,
+            cache=True, batch_size=EGO_BATCH_SIZE):
+        """
+        Return the list of the ego-centered graphs of the given users, as
+        returned by ``ego_graph``. They're computed together by batches of
+        ``batch_size`` users, which is a lot faster than one at a time.
 
-            return self._cache[key]
+        Results are cached in ``ego_cache``, an LRU cache bounded by the size
+        of the graphs in bytes; set its ``max_bytes`` attribute to change its
+        size. Use ``cache=False`` to bypass it.
+        """
+        keys = [(u_id, distance, float(inverse_popularity_threshold))
+                for u_id in u_ids]
+        egos = [self.ego_cache.get(key) if cache else None for key in keys]
 
+        movie_mask = None
         if inverse_popularity_threshold > 0:
-            t = inverse_popularity_threshold
-            filter_movies = lambda ms: [m for m in ms
-                    if Movie.get_by_id(m).inverse_popularity >= t]
-        else:
-            # no-op
-            filter_movies = lambda ms: ms
-
-        def compute_fans_movies():
-            fans = set([u_id])
-            movies = set()
-            curr_dist = 1
-
-            while curr_dist <= distance:
-                # Use the movies liked by all the current fans
-                movies.update(filter_movies(self.users_movies(fans)))
-
-                if distance == curr_dist:
-                    break
-
-                curr_dist += 1
-
-                # Use the fans of all the current movies
-                fans.update(self.movies_fans(movies))
-
-                if distance == curr_dist:
-                    break
+            movie_mask = (self.csr.movie_inverse_popularities() >=
+                    inverse_popularity_threshold)
 
-            return fans, movies
+        missing = [i for i, ego in enumerate(egos) if ego is None]
+        for batch in chunks(missing, batch_size):
+            nodes = self.csr.ego_nodes([node_id(u_ids[i]) for i in batch],
+                    distance=distance, movie_mask=movie_mask)
 
-        fans, movies = compute_fans_movies()
-        nodes = fans.union(movies)
-        return RatingsGraph(self.g.subgraph(nodes))
+            for i, (users, movies) in zip(batch, nodes):
+                egos[i] = EgoGraph(self.csr, users, movies)
+                if cache:
+                    self.ego_cache.set(keys[i], egos[i])
 
+        return egos
 
     def user_movies_gatekeepers(self, u_id,
             gatekeepers_count=1,
@@ -186,7 +499,7 @@ class RatingsGraph(object):
         """
         if buddies is None:
             b = RatingsGraph.users_buddies(buddy_threshold)
-            buddies = b.edge[u_id].keys()
+            buddies = b.buddies(u_id)
 
         gatekeepers = defaultdict(list)
 
@@ -218,19 +531,110 @@ class RatingsGraph(object):
             gatekeepers_count=1, buddy_threshold=0, buddies=None):
         """
         Return a ``dict`` mapping each user to its gatekeepers, similarly to
-        what :meth:`user_movies_gatekeepers` returns for one user.
+        what :meth:`user_movies_gatekeepers` returns for one user. They're
+        computed for all the users at once; see
+        :func:`~movies.gatekeepers.users_gatekeepers`.
         """
         if buddies is None:
             buddies = RatingsGraph.users_buddies(buddy_threshold)
 
-        return {u: self.user_movies_gatekeepers(u,
-            gatekeepers_count=gatekeepers_count, buddies=buddies.edge[u])
-                for u in buddies.node}
+        return dict(users_gatekeepers(self, buddies.users(),
+            gatekeepers_count=gatekeepers_count))
+
+    def _node_keys(self, name, keys):
+        """
+        Return a list of the keys of the nodes returned by the ``name``
+        method of the underlying graph. The keys are computed once; the
+        returned list is a copy that callers can modify.
+        """
+        if name not in self._keys:
+            self._keys[name] = keys(getattr(self.csr, name)())
+        return list(self._keys[name])
+
+    def _node_bitsets(self, name, ids, keys, pack):
+        """
+        Return the rows of the bitsets ``name`` for the given nodes keys. The
+        bitsets of all the nodes are packed by ``pack`` the first time they're
+        needed. Unknown nodes have empty bitsets.
+        """
+        if name not in self._bitsets:
+            self._bitsets[name] = pack()
+        rows, known = id_rows(ids, node_ids(keys))
+        bits = self._bitsets[name][rows]
+        bits[~known] = 0
+        return bits
 
     def dump(self, filename):
-        g = {n: ns.keys() for n, ns in self.g.edge.items()}
+        g = {u: self.user_movies(u) for u in self.users()}
+        g.update({m: self.movie_fans(m) for m in self.movies()})
         with open(filename, "w") as f:
             f.write(json.dumps(g))
 
-    def _neighbours(self, n):
-        return self.g.edge.get(n, {}).keys()
+class EgoGraph(object):
+    """
+    The nodes of an ego-centered graph, as returned by
+    ``RatingsGraph.ego_graph``. It only holds the sorted arrays of the ids of
+    its users and movies; use ``subgraph`` to get the graph itself.
+    """
+
+    def __init__(self, graph, user_ids, movie_ids):
+        # the BipartiteGraph this is a part of
+        self.graph = graph
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+
+    @property
+    def nbytes(self):
+        return self.user_ids.nbytes + self.movie_ids.nbytes
+
+    def __contains__(self, key):
+        ids = self.user_ids if key.startswith("u") else self.movie_ids
+        i = np.searchsorted(ids, node_id(key))
+        return i < len(ids) and ids[i] == node_id(key)
+
+    def users(self):
+        """Return the users"""
+        return user_keys(self.user_ids)
+
+    def movies(self):
+        """Return the movies"""
+        return movie_keys(self.movie_ids)
+
+    def user_count(self):
+        """Return the number of users"""
+        return len(self.user_ids)
+
+    def movie_count(self):
+        """Return the number of movies"""
+        return len(self.movie_ids)
+
+    def subgraph(self):
+        """
+        Return the ``RatingsGraph`` induced by these nodes.
+        """
+        return RatingsGraph(self.graph.subgraph(self.user_ids,
+            self.movie_ids))
+
+def node_id(key):
+    """
+    Return the integer id of a node key, e.g. ``42`` for ``"u42"``.
+    """
+    return int(key[1:])
+
+def node_ids(keys):
+    """
+    Return the integer ids of the given nodes keys as an array.
+    """
+    return np.array([node_id(k) for k in keys], dtype=np.int64)
+
+def user_keys(ids):
+    """
+    Return the nodes keys of the given users ids.
+    """
+    return ["u%d" % u for u in ids.tolist()]
+
+def movie_keys(ids):
+    """
+    Return the nodes keys of the given movies ids.
+    """
+    return ["m%d" % m for m in ids.tolist()]
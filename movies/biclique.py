@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Maximum balanced biclique: the largest ``N`` such that ``N`` users all liked
+the same ``N`` movies.
+
+A user or a movie with less than ``N`` neighbours can't be in such a
+biclique, and removing it lowers the degrees of the others: a ``N x N``
+biclique is in the ``N``-core of the graph, what's left once these nodes are
+removed until there are none. The largest core with ``N`` users and ``N``
+movies bounds the search from above and a greedy search bounds it from
+below. Each size in between is then looked for with a branch-and-bound search
+on the movies of the core, on packed bitsets of fans.
+"""
+
+import time
+
+import numpy as np
+
+from . import bitsets
+from .graph import expand_ranges
+
+__all__ = ["max_balanced_biclique"]
+
+# Number of movies the greedy search starts from
+GREEDY_SEEDS = 10
+
+class _Timeout(Exception):
+    pass
+
+def max_balanced_biclique(csr, time_budget=None):
+    """
+    Return a maximum balanced biclique of the ``BipartiteGraph`` ``csr`` as a
+    ``(users, movies, stats)`` tuple, where ``users`` and ``movies`` are
+    arrays of indexes of ``csr.user_ids`` and ``csr.movie_ids``: each user
+    liked each movie. There are at least ``stats["size"]`` of both.
+
+    ``time_budget`` is a number of seconds after which the search stops and
+    returns the biggest biclique found so far. ``stats`` also has the
+    ``upper_bound`` given by the cores, the size found by the greedy search
+    (``greedy``), the number of ``nodes`` of the search, ``optimal`` and
+    ``seconds``.
+    """
+    start = time.time()
+    deadline = start + time_budget if time_budget is not None else None
+
+    n_users, n_movies = len(csr.user_ids), len(csr.movie_ids)
+    lengths = csr.user_end - csr.user_start
+    edge_users = np.repeat(np.arange(n_users), lengths)
+    edge_movies = csr.user_idx[expand_ranges(csr.user_start, lengths)]
+
+    fans = bitsets.pack_rows(csr.movie_start, csr.movie_end, csr.movie_idx,
+            n_users)
+    movies_of = bitsets.pack_rows(csr.user_start, csr.user_end, csr.user_idx,
+            n_movies)
+
+    users, movies = _greedy(fans, csr.movie_degrees())
+    size = min(len(users), len(movies))
+    stats = {"greedy": size, "nodes": 0, "optimal": False}
+
+    # the biggest cores, from the one of the next size to look for
+    cores = []
+    alive_users = np.ones(n_users, dtype=bool)
+    alive_movies = np.ones(n_movies, dtype=bool)
+    k = size + 1
+    while True:
+        alive_users, alive_movies = _core(edge_users, edge_movies,
+                alive_users, alive_movies, k)
+        if alive_users.sum() < k or alive_movies.sum() < k:
+            break
+        cores.append((k, alive_users, alive_movies))
+        k += 1
+    stats["upper_bound"] = size + len(cores)
+
+    search = _Search(fans, movies_of, deadline, stats)
+    try:
+        for k, alive_users, alive_movies in cores:
+            if k <= size:
+                continue
+            found = search.find(k, alive_users, alive_movies,
+                    csr.movie_degrees())
+            if found is None:
+                stats["upper_bound"] = k - 1
+                break
+            users, movies = found
+            size = k
+        stats["optimal"] = True
+    except _Timeout:
+        pass
+
+    stats["size"] = size
+    stats["seconds"] = time.time() - start
+    return users, movies, stats
+
+def _greedy(fans, degrees):
+    """
+    Return a balanced biclique found by greedily adding the movie that keeps
+    the most common fans, from each one of the most popular movies.
+    """
+    best = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    for seed in np.argsort(-degrees, kind="mergesort")[:GREEDY_SEEDS]:
+        common = fans[seed].copy()
+        chosen = [seed]
+        while True:
+            if min(len(chosen), bitsets.popcount(common)) > min(map(len,
+                    best)):
+                best = (bitsets.indexes(common), np.array(chosen))
+
+            sizes = bitsets.intersection_sizes(common, fans)
+            sizes[chosen] = -1
+            m = int(np.argmax(sizes))
+            # adding it can't give a bigger balanced biclique
+            if sizes[m] <= len(chosen):
+                break
+            chosen.append(m)
+            common &= fans[m]
+    return best
+
+def _core(edge_users, edge_movies, alive_users, alive_movies, k):
+    """
+    Return the masks of the users and movies of the ``k``-core of the graph
+    restricted to the alive users and movies.
+    """
+    while True:
+        live = alive_users[edge_users] & alive_movies[edge_movies]
+        user_degrees = np.bincount(edge_users[live],
+                minlength=len(alive_users))
+        movie_degrees = np.bincount(edge_movies[live],
+                minlength=len(alive_movies))
+        users = alive_users & (user_degrees >= k)
+        movies = alive_movies & (movie_degrees >= k)
+        if users.sum() == alive_users.sum() and \
+                movies.sum() == alive_movies.sum():
+            return users, movies
+        alive_users, alive_movies = users, movies
+
+class _Search(object):
+    """
+    Branch-and-bound search of a ``k x k`` biclique. A node is a set of
+    chosen movies, their common fans and the movies that can still be added.
+    A branch is pruned when there aren't enough candidate movies with at
+    least ``k`` of the common fans, or enough common fans who liked enough
+    of the candidates.
+    """
+
+    def __init__(self, fans, movies_of, deadline, stats):
+        self.fans = fans
+        self.movies_of = movies_of
+        self.deadline = deadline
+        self.stats = stats
+
+    def find(self, k, alive_users, alive_movies, degrees):
+        """
+        Return the ``(users, movies)`` of a ``k x k`` biclique in the given
+        core, or ``None`` if there's none.
+        """
+        self.k = k
+        users = bitsets.pack(np.flatnonzero(alive_users), len(alive_users))
+        candidates = np.flatnonzero(alive_movies)
+        # the most popular movies first
+        candidates = candidates[np.argsort(-degrees[candidates],
+            kind="mergesort")]
+        found = self._search(users, [], candidates)
+        if found is None:
+            return None
+        users, movies = found
+        return bitsets.indexes(users), np.array(movies)
+
+    def _search(self, users, chosen, candidates):
+        self.stats["nodes"] += 1
+        if self.deadline is not None and time.time() > self.deadline:
+            raise _Timeout()
+
+        k = self.k
+        if len(chosen) >= k:
+            return users, chosen
+
+        # the candidates must have enough common fans and the common fans
+        # must like enough candidates; each filter can make the other one
+        # remove more
+        needed = k - len(chosen)
+        n_users = len(users) * 64
+        n_movies = self.movies_of.shape[1] * 64
+        while True:
+            sizes = bitsets.intersection_sizes(users, self.fans[candidates])
+            candidates = candidates[sizes >= k]
+            if len(candidates) < needed:
+                return None
+
+            idx = bitsets.indexes(users)
+            counts = bitsets.intersection_sizes(
+                    bitsets.pack(candidates, n_movies), self.movies_of[idx])
+            kept = idx[counts >= needed]
+            if len(kept) < k:
+                return None
+            users = bitsets.pack(kept, n_users)
+            if len(kept) == len(idx):
+                break
+
+        for i, m in enumerate(candidates):
+            if len(candidates) - i < needed:
+                break
+            found = self._search(users & self.fans[m], chosen + [m],
+                    candidates[i+1:])
+            if found is not None:
+                return found
+        return None
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Packed bitsets of nodes indexes.
+
+A set of indexes lower than ``size`` is a row of ``words(size)`` ``uint64``
+words; a 2D array is a list of such sets, e.g. the fans of each movie. The
+sizes of intersections, unions and differences are computed on whole rows at
+once, with a popcount table on their bytes, and broadcast like NumPy
+operations: ``intersection_sizes(fans[i], fans)`` gives the number of common
+fans between the movie ``i`` and each movie.
+
+The bits past ``size`` in the last word are always zero; use ``difference``
+rather than ``~`` to get a complement.
+"""
+
+from binascii import hexlify
+
+import numpy as np
+
+from .graph import expand_ranges
+
+__all__ = ["WORD_DTYPE", "words", "pack", "pack_rows", "indexes", "popcount",
+        "intersection_sizes", "union_sizes", "difference_sizes",
+        "difference", "to_int"]
+
+WORD_DTYPE = np.uint64
+
+# Maximum number of bytes packed at once by ``pack_rows``; the bytes are
+# counted as float64 so the default uses about 256MB at most.
+MAX_PACK_BYTES = 2**25
+
+# number of bits set in each byte
+_POPCOUNTS = np.array([bin(i).count("1") for i in range(256)],
+        dtype=np.uint8)
+
+def words(size):
+    """
+    Return the number of words of a bitset of ``size`` indexes.
+    """
+    return -(-size // 64)
+
+def pack(idx, size):
+    """
+    Return the bitset of the given indexes, all lower than ``size``.
+
+    >>> indexes(pack([0, 5, 64], 70)).tolist()
+    [0, 5, 64]
+    """
+    return pack_rows(np.array([0]), np.array([len(idx)]),
+            np.asarray(idx, dtype=np.int64), size)[0]
+
+def pack_rows(start, end, idx, size, max_bytes=MAX_PACK_BYTES):
+    """
+    Return the bitsets of the rows of a CSR structure as a 2D array: the row
+    ``i`` has the indexes ``idx[start[i]:end[i]]``, which must be distinct
+    and lower than ``size``.
+    """
+    n_bytes = words(size) * 8
+    bits = np.zeros((len(start), n_bytes), dtype=np.uint8)
+
+    # the rows are packed by blocks; the bits of a byte are distinct so their
+    # sum is their union
+    step = max(1, max_bytes // max(n_bytes, 1))
+    for i in range(0, len(start), step):
+        lengths = end[i:i+step] - start[i:i+step]
+        cols = idx[expand_ranges(start[i:i+step], lengths)].astype(np.int64)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        block = np.bincount(rows * n_bytes + (cols >> 3),
+                weights=1 << (cols & 7), minlength=len(lengths) * n_bytes)
+        bits[i:i+step] = block.reshape((len(lengths), n_bytes))
+
+    return bits.view(WORD_DTYPE)
+
+def indexes(bits):
+    """
+    Return the sorted indexes of a bitset.
+    """
+    flags = np.unpackbits(np.ascontiguousarray(bits).view(np.uint8))
+    # unpackbits puts the highest bit of each byte first
+    return np.flatnonzero(flags.reshape((-1, 8))[:, ::-1].ravel())
+
+def popcount(bits):
+    """
+    Return the size of each bitset of ``bits`` (the size of ``bits`` if it's
+    a single one).
+
+    >>> popcount(pack([1, 2, 3, 100], 128))
+    4
+    """
+    # the bytes of each bitset are along the last axis
+    counts = _POPCOUNTS[np.ascontiguousarray(bits).view(np.uint8)]
+    return counts.sum(axis=-1, dtype=np.int64)
+
+def intersection_sizes(a, b):
+    """Return the sizes of the intersections of the bitsets ``a`` and ``b``"""
+    return popcount(a & b)
+
+def union_sizes(a, b):
+    """Return the sizes of the unions of the bitsets ``a`` and ``b``"""
+    return popcount(a | b)
+
+def difference_sizes(a, b):
+    """
+    Return the number of indexes of the bitsets ``a`` that aren't in the
+    bitsets ``b``.
+    """
+    return popcount(difference(a, b))
+
+def difference(a, b):
+    """Return the bitsets ``a`` without the indexes of the bitsets ``b``"""
+    return a & ~b
+
+def to_int(bits):
+    """
+    Return a bitset as a Python int with the same number of bits set, e.g.
+    for :func:`~movies.setcover.set_cover`. The ints of bitsets of the same
+    size have the same bits for the same indexes.
+    """
+    return int(hexlify(np.ascontiguousarray(bits).tobytes()) or "0", 16)
@@ -0,0 +1,200 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Index of the links between users ("buddies"), as stored in ``UserLink``.
+
+The links are loaded once and sorted by score, so that the links with a score
+of at least some threshold are a slice of the index. Each user's buddies are
+also sorted by decreasing score, which gives the buddies of a user at any
+threshold without copying anything.
+"""
+
+import networkx as nx
+import numpy as np
+
+from .db import UserLink, fetch_batches
+from .graph import ID_DTYPE, csr_offsets, prefix_ends
+
+__all__ = ["BuddyIndex", "BuddyGraph", "buddy_index"]
+
+# Index of the links of the DB, once loaded
+_index = {}
+
+def buddy_index():
+    """
+    Return the ``BuddyIndex`` of the links stored in the DB. It's loaded once
+    per process; use ``invalidate_buddy_index`` when the links change.
+    """
+    if "index" not in _index:
+        _index["index"] = BuddyIndex.load()
+    return _index["index"]
+
+def invalidate_buddy_index():
+    """
+    Forget the loaded ``BuddyIndex``; the next ``buddy_index`` call reloads
+    it.
+    """
+    _index.clear()
+
+class BuddyIndex(object):
+    """
+    All the links between users, sorted by increasing score: ``user1[i]``
+    and ``user2[i]`` are buddies with the score ``scores[i]``.
+
+    ``user_ids`` are the sorted ids of the users who have at least one link.
+    The buddies of the user at index ``i`` are
+    ``buddy_ids[ptr[i]:ptr[i+1]]``, with the scores ``buddy_scores``; they
+    are sorted by decreasing score.
+    """
+
+    def __init__(self, user1, user2, scores):
+        order = np.argsort(scores, kind="mergesort")
+        self.user1 = np.asarray(user1, dtype=ID_DTYPE)[order]
+        self.user2 = np.asarray(user2, dtype=ID_DTYPE)[order]
+        self.scores = np.asarray(scores, dtype=np.float64)[order]
+
+        # each link is in the adjacency of both its users
+        users = np.concatenate((self.user1, self.user2))
+        others = np.concatenate((self.user2, self.user1))
+        scores = np.concatenate((self.scores, self.scores))
+
+        self.user_ids = np.unique(users)
+        rows = np.searchsorted(self.user_ids, users)
+        order = np.lexsort((others, -scores, rows))
+        self.ptr = csr_offsets(rows[order], len(self.user_ids))
+        self.buddy_ids = others[order]
+        self.buddy_scores = scores[order]
+
+    @classmethod
+    def load(cls):
+        """
+        Load the index from the ``UserLink`` table.
+        """
+        query = UserLink.select(UserLink.user1, UserLink.user2,
+                UserLink.score)
+
+        dtype = [("user1", ID_DTYPE), ("user2", ID_DTYPE),
+                ("score", np.float64)]
+        batches = [np.array(rows, dtype=dtype)
+                for rows in fetch_batches(query)]
+        links = (np.concatenate(batches) if batches
+                else np.zeros(0, dtype=dtype))
+        return cls(links["user1"], links["user2"], links["score"])
+
+    def __len__(self):
+        return len(self.scores)
+
+    def at_least(self, threshold, strict=False):
+        """
+        Return the ``BuddyGraph`` of the links with a score of at least
+        ``threshold``, or above it if ``strict`` is true.
+        """
+        return BuddyGraph(self, threshold, strict)
+
+    def quantiles(self, n=10):
+        """
+        Return the ``n+1`` scores that split the links in ``n`` groups of
+        the same size, from the lowest score to the highest one. For example
+        ``n=10`` gives the minimum, the deciles and the maximum. These are
+        actual scores of the links, not interpolations.
+        """
+        if not len(self.scores):
+            return []
+        last = len(self.scores) - 1
+        return [float(self.scores[k * last // n]) for k in range(n + 1)]
+
+class BuddyGraph(object):
+    """
+    The buddies graph at a given threshold, as a view over a ``BuddyIndex``.
+    Users are identified as in ``RatingsGraph``, e.g. ``"u42"``.
+    """
+
+    def __init__(self, index, threshold, strict=False):
+        self.index = index
+        self.threshold = threshold
+        self.strict = strict
+
+        side = "right" if strict else "left"
+        self._first = np.searchsorted(index.scores, threshold, side=side)
+        self._ends = None
+
+    def __len__(self):
+        """Return the number of links"""
+        return len(self.index.scores) - self._first
+
+    def __contains__(self, u_id):
+        return self.degree(u_id) > 0
+
+    def links(self):
+        """
+        Return the links as three arrays ``(user1, user2, scores)``, sorted
+        by increasing score. These are views on the index's arrays.
+        """
+        i = self._first
+        index = self.index
+        return index.user1[i:], index.user2[i:], index.scores[i:]
+
+    def users(self):
+        """Return the users who have at least one buddy"""
+        ends = self._buddies_ends()
+        ids = self.index.user_ids[ends > self.index.ptr[:-1]]
+        return ["u%d" % u for u in ids.tolist()]
+
+    def degree(self, u_id):
+        """Return the number of buddies of a user"""
+        i = self._row(u_id)
+        if i < 0:
+            return 0
+        return int(self._buddies_ends()[i] - self.index.ptr[i])
+
+    def buddies(self, u_id):
+        """
+        Return the buddies of a user, from the closest to the farthest one.
+        """
+        return ["u%d" % u for u in self._buddies(u_id)[0].tolist()]
+
+    def buddies_scores(self, u_id):
+        """
+        Return a ``dict`` mapping each buddy of a user to their score.
+        """
+        ids, scores = self._buddies(u_id)
+        return {"u%d" % u: s for u, s in zip(ids.tolist(), scores.tolist())}
+
+    def to_networkx(self):
+        """
+        Return the buddies graph as a networkx graph with a ``score`` on each
+        edge.
+        """
+        g = nx.Graph()
+        user1, user2, scores = self.links()
+        g.add_edges_from(("u%d" % u1, "u%d" % u2, {"score": s})
+                for u1, u2, s in zip(user1.tolist(), user2.tolist(),
+                    scores.tolist()))
+        return g
+
+    def _row(self, u_id):
+        ids = self.index.user_ids
+        u = int(u_id[1:])
+        i = np.searchsorted(ids, u)
+        return int(i) if i < len(ids) and ids[i] == u else -1
+
+    def _buddies(self, u_id):
+        i = self._row(u_id)
+        if i < 0:
+            return self.index.buddy_ids[:0], self.index.buddy_scores[:0]
+        start, end = self.index.ptr[i], self._buddies_ends()[i]
+        return (self.index.buddy_ids[start:end],
+                self.index.buddy_scores[start:end])
+
+    def _buddies_ends(self):
+        """
+        Return the end offsets of the buddies of each user at this threshold.
+        They're computed the first time they're needed.
+        """
+        if self._ends is None:
+            threshold = self.threshold
+            if self.strict:
+                threshold = np.nextafter(threshold, np.inf)
+            self._ends = prefix_ends(self.index.ptr, self.index.buddy_scores,
+                    threshold)
+        return self._ends
@@ -3,7 +3,7 @@
 from collections import OrderedDict
 from .db import KeyValue, init_db
 
-__all__ = ["Cache"]
+__all__ = ["Cache", "LRUCache"]
 
 class Cache(object):
     def __init__(self, key_prefix="cache", max_items=100):
@@ -74,6 +74,8 @@ class Cache(object):
             # not to break anything
             _fn.__name__ = fn.__name__
             _fn.__doc__ = fn.__doc__
+            # let the cached value be dropped when it's outdated
+            _fn.invalidate = lambda: self.invalidate(key)
 
             self.memoized0.append(_fn)
 
@@ -94,6 +96,13 @@ class Cache(object):
         self._values[key] = value
         self._check_size()
 
+    def invalidate(self, key):
+        """
+        Remove the cached value for the given key, if any.
+        """
+        KeyValue.del_key(key)
+        self._values.pop(key, None)
+
     def warmup(self):
         """
         Call all memoized functions to ensure their result is in the cache.
@@ -131,3 +140,74 @@ class Cache(object):
             return None
         # http://stackoverflow.com/a/9917213/735926
         return next(reversed(self._values))
+
+
+class LRUCache(object):
+    """
+    An in-memory LRU cache bounded by the total size of its values in bytes
+    instead of their number. When a value is added the least recently used
+    ones are removed until the size is under ``max_bytes``; a value bigger
+    than that is not kept at all.
+
+    The size of a value is given by ``sizeof``, which uses its ``nbytes``
+    attribute like NumPy arrays; override it for other values.
+    """
+
+    def __init__(self, max_bytes):
+        # total size of the values
+        self.nbytes = 0
+        # key -> (value, size), from the least to the most recently used
+        self._values = OrderedDict()
+        self.max_bytes = max_bytes
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._check_size()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def sizeof(self, value):
+        return value.nbytes
+
+    def get(self, key, default=None):
+        """
+        Return the value for ``key``, or ``default`` if it's not cached.
+        """
+        if key not in self._values:
+            return default
+        # move it at the end
+        item = self._values.pop(key)
+        self._values[key] = item
+        return item[0]
+
+    def set(self, key, value):
+        """
+        Cache a key/value pair.
+        """
+        if key in self._values:
+            self.nbytes -= self._values.pop(key)[1]
+        size = self.sizeof(value)
+        self._values[key] = (value, size)
+        self.nbytes += size
+        self._check_size()
+
+    def clear(self):
+        """
+        Remove all the cached values.
+        """
+        self._values.clear()
+        self.nbytes = 0
+
+    def _check_size(self):
+        while self.nbytes > self.max_bytes and self._values:
+            _, (_, size) = self._values.popitem(last=False)
+            self.nbytes -= size
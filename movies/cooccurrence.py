@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Co-occurrences of movies: the number of fans each pair of movies has in
+common, and their Jaccard index.
+
+The counts are computed for blocks of movies at a time on the same incidence
+structure as the users similarities, going from each movie to its fans then
+to their movies. Pairs that can't reach the Jaccard threshold given their
+degrees are dropped before they're counted.
+"""
+
+import numpy as np
+
+from .graph import expand_ranges
+from .similarity import Incidence, MAX_BLOCK_ENTRIES, blocks
+
+__all__ = ["MoviePairs", "movie_pairs"]
+
+class MoviePairs(object):
+    """
+    Pairs of movies with fans in common, sorted by decreasing Jaccard index.
+    For each ``i``, the movies ``movie1[i]`` and ``movie2[i]`` (integer ids,
+    with ``movie1[i] < movie2[i]``) have ``common[i]`` fans in common and a
+    Jaccard index of ``scores[i]``.
+    """
+
+    def __init__(self, movie1, movie2, common, scores):
+        order = np.lexsort((movie2, movie1, -scores))
+        self.movie1 = movie1[order]
+        self.movie2 = movie2[order]
+        self.common = common[order]
+        self.scores = scores[order]
+
+    def __len__(self):
+        return len(self.scores)
+
+    def above(self, t):
+        """
+        Return the pairs with a Jaccard index above ``t``. They're a slice of
+        these ones; nothing is recomputed.
+        """
+        end = len(self.scores) - np.searchsorted(self.scores[::-1], t,
+                side="right")
+        return MoviePairs(self.movie1[:end], self.movie2[:end],
+                self.common[:end], self.scores[:end])
+
+    def to_dict(self):
+        """
+        Return the pairs as a ``dict`` of ``dict``, like
+        ``insights.common_movies_fans`` returns them: ``movie -> movie ->
+        ratio``, with the first movie of each pair as the outer key.
+        """
+        ratios = {}
+        for m1, m2, s in zip(self.movie1.tolist(), self.movie2.tolist(),
+                self.scores.tolist()):
+            ratios.setdefault("m%d" % m1, {})["m%d" % m2] = s
+        return ratios
+
+def movie_pairs(rg, t=0, min_fans=2, max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Return the :class:`MoviePairs` of the movies that have at least
+    ``min_fans`` fans each and a Jaccard index above ``t``.
+
+    ``max_entries`` bounds the size of the intermediary arrays.
+    """
+    inc = Incidence(rg)
+    n_movies = len(inc.movies)
+    movie_ids = np.array([int(m[1:]) for m in inc.movies], dtype=np.int64)
+    degrees = inc.movie_degrees()
+    user_degrees = inc.user_degrees()
+
+    eligible = degrees >= max(min_fans, 1)
+    movies = np.flatnonzero(eligible)
+
+    # the number of entries of the movies expansion for each movie
+    costs = np.zeros(len(movies), dtype=np.int64)
+    for i, m in enumerate(movies):
+        fans = inc.movie_idx[inc.movie_start[m]:inc.movie_end[m]]
+        costs[i] = user_degrees[fans].sum()
+
+    columns = ([], [], [], [])
+    for block in blocks(costs, n_movies, max_entries):
+        block = movies[block]
+
+        # fans of each movie of the block
+        starts = inc.movie_start[block]
+        lengths = inc.movie_end[block] - starts
+        fans = inc.movie_idx[expand_ranges(starts, lengths)]
+        rows = np.repeat(np.arange(len(block)), lengths)
+
+        # movies of each one of these fans
+        starts = inc.user_start[fans]
+        lengths = inc.user_end[fans] - starts
+        others = inc.user_idx[expand_ranges(starts, lengths)]
+        rows = np.repeat(rows, lengths)
+
+        # each pair once, and only if its Jaccard index can be above t: it's
+        # at most the ratio of the smaller degree to the bigger one
+        keep = (others > block[rows]) & eligible[others]
+        if t > 0:
+            d1, d2 = degrees[block][rows], degrees[others]
+            keep &= (d2 > t * d1) & (d1 > t * d2)
+        rows, others = rows[keep], others[keep]
+
+        counts = np.bincount(rows * n_movies + others,
+                minlength=len(block) * n_movies)
+        pairs = np.flatnonzero(counts)
+        rows, others = pairs // n_movies, pairs % n_movies
+        common = counts[pairs]
+        union = degrees[block][rows] + degrees[others] - common
+        scores = common / union.astype(np.float64)
+
+        keep = scores > t
+        for column, values in zip(columns, (movie_ids[block][rows],
+                movie_ids[others], common, scores)):
+            column.append(values[keep])
+
+    if not columns[0]:
+        return MoviePairs(*(np.zeros(0, dtype=dtype)
+            for dtype in (np.int64, np.int64, np.int64, np.float64)))
+    return MoviePairs(*[np.concatenate(c) for c in columns])
@@ -1,23 +1,52 @@
 # -*- coding: UTF-8 -*-
 
 from .data_importers import Ml100kImporter, Ml1mImporter, Ml10mImporter
+from .data_importers import Ml20mImporter, Ml25mImporter
 
-def import_data(directory, dataset_format, verbose=False):
+FORMATS = {
+    "ml-100k": Ml100kImporter,
+    "ml-1m": Ml1mImporter,
+    "ml-10m": Ml10mImporter,
+    "ml-20m": Ml20mImporter,
+    "ml-25m": Ml25mImporter,
+}
+
+def get_importer(dataset_format):
+    if dataset_format in FORMATS:
+        return FORMATS[dataset_format]
+    raise NotImplementedError("format '%s'" % dataset_format)
+
+def import_data(directory, dataset_format, verbose=False, workers=1,
+        bulk=False, links_min_score=0, check=False):
     """
-    Import data from a movielens dataset located in ``directory``.
+    Import data from a movielens dataset located in ``directory``. If
+    ``workers`` is greater than 1 the files are parsed by that many processes.
+    ``bulk=True`` enables the importer's bulk-load mode. Only the user links
+    with a score of at least ``links_min_score`` are stored.
+
+    With ``check=True`` the cached ratings counts, dates and averages are
+    re-computed one object at a time and the list of those that differ is
+    returned, see ``Importer.check_post_import``. This is slow.
 
     Supported formats:
         * ``ml-100k``: MovieLens 100k dataset
         * ``ml-1m``: MovieLens 1M dataset
         * ``ml-10m``: MovieLens 10M dataset
+        * ``ml-20m``: MovieLens 20M dataset
+        * ``ml-25m``: MovieLens 25M dataset
     """
-    fmts = {
-        "ml-100k": Ml100kImporter,
-        "ml-1m": Ml1mImporter,
-        "ml-10m": Ml10mImporter,
-    }
+    return get_importer(dataset_format)(directory, verbose=verbose,
+            workers=workers).run(bulk=bulk, links_min_score=links_min_score,
+                    check=check)
 
-    if dataset_format in fmts:
-        fmts[dataset_format](directory, verbose=verbose).run()
-    else:
-        raise NotImplementedError("format '%s'" % dataset_format)
+def ingest_data(dataset_format, movies=None, users=None, ratings=None,
+        verbose=False, links_min_score=None):
+    """
+    Add the movies, users and ratings from the given delta files to the
+    already-imported dataset. The files must use the format of the dataset,
+    see ``import_data``. The user links are updated with a minimal score of
+    ``links_min_score``; the default is the one used for the import.
+    """
+    get_importer(dataset_format)(None, verbose=verbose).ingest(
+            movies=movies, users=users, ratings=ratings,
+            min_score=links_min_score)
@@ -1,83 +1,354 @@
 # -*- coding: UTF-8 -*-
 
+import os
+import csv
+import codecs
+import zipfile
+from collections import deque
 from datetime import datetime
-from pyzipcode import ZipCodeDatabase
-
-from .analysis import global_ratings_graph
-from .db import User, Movie, Rating, UserLink, init_db, db
+from multiprocessing import Pool
+from pyzipcode import ZipCodeDatabase, ZipCode
+
+from .analysis import global_ratings_graph, update_global_ratings_graph
+from .analysis import movies_genres_distribution, POSITIVE_RATING
+from .buddies import invalidate_buddy_index
+from .db import User, Movie, Rating, UserLink, KeyValue, init_db, db
+from .db import OccupationField
+from .db import bulk_load, max_insert_rows
+from .listutils import chunks
+from .similarity import user_pairs, user_pairs_of
 
 zcdb = ZipCodeDatabase()
 
-def set_user_dict_city(item):
-    try:
-        zipcode = zcdb[item["zip_code"]]
-        item["city"] = zipcode.city
-        item["state"] = zipcode.state
-    except IndexError:
-        # bad zipcodes
-        item["city"] = None
-        item["state"] = None
+# Key of the minimal score of the stored user links in the KeyValue table
+LINKS_MIN_SCORE_KEY = "data_importers.links_min_score"
+
+class ZipCodeResolver(object):
+    """
+    Resolve zip codes to ``(city, state)`` pairs. Each distinct zip code is
+    looked up only once; several of them can be looked up with one query with
+    ``resolve_many``. ``misses`` counts the zip codes that were looked up in
+    the zip codes database and ``hits`` the calls to ``get`` that didn't need
+    to.
+    """
+
+    # Maximum number of zip codes looked up in one query
+    BATCH_SIZE = 500
+
+    def __init__(self, zcdb):
+        self.zcdb = zcdb
+        self._cities = {}
+        self.hits = 0
+        self.misses = 0
 
-def fix_encoding(s):
-    return s.decode("iso-8859-1").encode("utf8")
+    def resolve_many(self, zip_codes):
+        """
+        Look up all the given zip codes that aren't known yet.
+        """
+        unknown = set(str(z) for z in zip_codes).difference(self._cities)
+        self.misses += len(unknown)
+
+        for batch in chunks(unknown, self.BATCH_SIZE):
+            query = "SELECT * FROM ZipCodes WHERE zip IN (%s)" % (
+                    ", ".join("?" * len(batch)))
+            for row in self.zcdb.conn_manager.query(query, batch):
+                zipcode = ZipCode(row)
+                # keep the first one like ZipCodeDatabase does
+                if zipcode.zip not in self._cities:
+                    self._cities[zipcode.zip] = (zipcode.city, zipcode.state)
+
+            for z in batch:
+                # bad zipcodes
+                self._cities.setdefault(z, (None, None))
+
+    def get(self, zip_code):
+        """
+        Return the ``(city, state)`` pair of a zip code, or ``(None, None)``
+        if it doesn't exist.
+        """
+        zip_code = str(zip_code)
+        if zip_code in self._cities:
+            self.hits += 1
+        else:
+            self.resolve_many([zip_code])
+        return self._cities[zip_code]
+
+def set_user_dict_city(item, zip_codes=None):
+    if zip_codes is None:
+        zip_codes = MlImporter.zip_codes
+    item["city"], item["state"] = zip_codes.get(item["zip_code"])
+
+def set_users_dicts_cities(items, zip_codes=None, chunk_size=1000):
+    """
+    Lazily set the city and state of users dicts that have a zip code. Their
+    zip codes are resolved by batches of ``chunk_size`` users.
+    """
+    if zip_codes is None:
+        zip_codes = MlImporter.zip_codes
+
+    for chunk in chunks(items, chunk_size):
+        zip_codes.resolve_many(
+                item["zip_code"] for item in chunk if "zip_code" in item)
+        for item in chunk:
+            if "zip_code" in item:
+                set_user_dict_city(item, zip_codes)
+            yield item
+
+# Size of the file pieces parsed by each worker process in parallel imports
+RANGE_SIZE = 4 * 1024 * 1024
+
+# Size of the blocks read from dataset files
+BLOCK_SIZE = 1024 * 1024
+
+def fix_encoding(s, encoding="iso-8859-1"):
+    """
+    Re-encode a string from ``encoding`` to UTF-8.
+    """
+    if encoding in ("utf8", "utf-8"):
+        return s
+    return s.decode(encoding).encode("utf8")
+
+def archive_member(filename):
+    """
+    Return an ``(archive, name)`` pair if ``filename`` is of the form
+    ``<archive>.zip/<name>``, ``None`` otherwise.
+    """
+    archive, name = os.path.split(filename)
+    if archive.endswith(".zip") and os.path.isfile(archive):
+        return archive, name
 
-def chunked_insert(model, items, chunk_size=150):
+def open_dataset_file(filename):
     """
-    Insert a bunch of items in chunks to be faster than one-by-one.
+    Open a dataset file for reading. ``filename`` can also be of the form
+    ``<archive>.zip/<name>`` to read the member of a zip archive whose
+    basename is ``<name>``, e.g. ``ml-10m.zip/ratings.dat`` for
+    ``ml-10M100K/ratings.dat``. The member is decompressed on the fly.
     """
-    # https://www.sqlite.org/limits.html#max_compound_select
+    member = archive_member(filename)
+    if member is None:
+        return open(filename, "rb")
+
+    archive, name = member
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if os.path.basename(info.filename) == name:
+                return zf.open(info)
+
+    raise IOError("No such file in '%s': '%s'" % (archive, name))
+
+def decode_lines(f, encoding="iso-8859-1", block_size=BLOCK_SIZE):
+    """
+    Lazily read a file by blocks, yielding its lines re-encoded from
+    ``encoding`` to UTF-8, without their newline.
+    """
+    if encoding in ("utf8", "utf-8"):
+        decode = lambda block, final: block
+    else:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        decode = lambda block, final: \
+                decoder.decode(block, final).encode("utf8")
+
+    rest = ""
+    while True:
+        block = f.read(block_size)
+        lines = (rest + decode(block, not block)).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+
+        if not block:
+            break
+
+    if rest:
+        yield rest
+
+def read_lines(filename, encoding="iso-8859-1"):
+    """
+    Lazily read a dataset file, yielding each line re-encoded from
+    ``encoding`` to UTF-8 and stripped. See ``open_dataset_file`` for the
+    supported filenames.
+    """
+    with open_dataset_file(filename) as f:
+        for line in decode_lines(f, encoding):
+            yield line.strip()
+
+def raw_blocks(filename, size=RANGE_SIZE):
+    """
+    Lazily read a dataset file by blocks of roughly ``size`` bytes that end
+    after a newline (or at the end of the file). This is used in parallel
+    imports instead of ``byte_ranges`` for files that can't be read at an
+    arbitrary position, such as archive members.
+    """
+    with open_dataset_file(filename) as f:
+        rest = ""
+        while True:
+            block = f.read(size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind("\n") + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+
+        if rest:
+            yield rest
+
+def byte_ranges(filename, size=RANGE_SIZE):
+    """
+    Split a file in ``(start, end)`` ranges of roughly ``size`` bytes each.
+    Ranges always start at the beginning of a line and end after a newline (or
+    at the end of the file).
+    """
+    total = os.path.getsize(filename)
+    ranges = []
+    with open(filename, "rb") as f:
+        start = 0
+        while start < total:
+            f.seek(min(start + size, total))
+            # finish the current line
+            f.readline()
+            end = min(f.tell(), total)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def read_range_lines(filename, start, end, encoding="iso-8859-1"):
+    """
+    Like ``read_lines`` but only for the lines in the given byte range.
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield fix_encoding(line, encoding).strip()
+
+def db_rows(model, items):
+    """
+    Convert dicts as given to ``insert_many`` into tuples of database values.
+    Default values are filled in the same way ``insert_many`` does. Return a
+    list of ``(columns, rows)`` pairs, one for each run of consecutive items
+    which have the same columns.
+    """
+    defaults = dict((f.name, v) for f, v in model._meta._default_dict.items())
+    groups = []
+    for item in items:
+        values = defaults.copy()
+        values.update(item)
+        fields = [f for f in model._meta.sorted_fields if f.name in values]
+        columns = tuple(f.db_column for f in fields)
+        row = tuple(f.db_value(values[f.name]) for f in fields)
+
+        if groups and groups[-1][0] == columns:
+            groups[-1][1].append(row)
+        else:
+            groups.append((columns, [row]))
+    return groups
+
+def insert_rows(model, groups):
+    """
+    Insert rows of database values as returned by ``db_rows``.
+    """
+    q = db.quote_char
     with db.atomic():
-        for idx in range(0, len(items), chunk_size):
-            model.insert_many(items[idx:idx+chunk_size]).execute()
+        cursor = db.get_cursor()
+        for columns, rows in groups:
+            sql = "INSERT INTO %s%s%s (%s) VALUES (%s)" % (
+                    q, model._meta.db_table, q,
+                    ", ".join("%s%s%s" % (q, c, q) for c in columns),
+                    ", ".join([db.interpolation] * len(columns)))
+            cursor.executemany(sql, rows)
+
+def _parse_lines(importer, kind, model, lines):
+    items = importer.parse_items(kind, lines)
+    if importer.unique(kind):
+        items = unique_by_pk(model, items)
+    return db_rows(model, items)
+
+def _parse_range(args):
+    """
+    Worker function for parallel imports: parse a byte range of a file and
+    return it as database rows.
+    """
+    importer, kind, model, start, end = args
+    return _parse_lines(importer, kind, model,
+            read_range_lines(importer.filename(kind), start, end,
+                importer.encoding))
+
+def _parse_block(args):
+    """
+    Worker function for parallel imports: parse a block of lines as returned
+    by ``raw_blocks`` and return it as database rows.
+    """
+    importer, kind, model, block = args
+    lines = fix_encoding(block, importer.encoding).split("\n")
+    # the block ends with a newline except at the end of the file
+    if not lines[-1]:
+        lines.pop()
+    return _parse_lines(importer, kind, model,
+            (line.strip() for line in lines))
+
+def unique_by_pk(model, items):
+    """
+    Filter dicts as given to ``insert_many`` to keep only the first one for
+    each primary key.
+    """
+    pk = model._meta.primary_key.name
+    seen = set()
+    for item in items:
+        if item[pk] not in seen:
+            seen.add(item[pk])
+            yield item
+
+def chunked_insert(model, items, chunk_size=None):
+    """
+    Insert a bunch of items in chunks to be faster than one-by-one. ``items``
+    can be any iterable, including a generator: it's consumed one chunk at a
+    time so that the memory usage doesn't depend on the number of items.
+
+    By default chunks are as large as SQLite's host parameters limit allows.
+    """
+    if chunk_size is None:
+        chunk_size = max_insert_rows(model)
+
+    with db.atomic():
+        for chunk in chunks(items, chunk_size):
+            model.insert_many(chunk).execute()
 
 def parse_ts(s):
     # timestamp in secs
     return datetime.utcfromtimestamp(int(s))
 
-def create_user_links(verbose=False):
+def create_user_links(verbose=False, min_score=0, u_ids=None):
     """
-    Store user links in the DB so that loading the graph can be fast.
+    Store user links in the DB so that loading the graph can be fast. Only
+    links with a Jaccard index of at least ``min_score`` are kept. If
+    ``u_ids`` is given only the links of these users are re-computed.
 
     On the ml-100k dataset loading all these users is not tremendously faster
     than re-computing the whole graph.
 
-    On the ml-1m dataset this adds a lot of data in the DB; growing it from
-    ~130MB to >1.6GB. It also takes a lot of time (>30m) and uses a lot of RAM
-    (>10GB); I never waited until it finishes.
+    Each pair of users is stored once as four numbers, but on large datasets
+    most users have at least one movie in common with each other: use
+    ``min_score`` to keep only the closest ones.
     """
     rg = global_ratings_graph()
     if verbose:
         print "Ratings graph loaded."
-    uids = rg.users()
-    links = []
-    for user in User.select():
-        uid1 = "u%s" % user.user_id
-        m1 = set(rg.user_movies(uid1))
 
-        buddies = {}
+    if u_ids is None:
+        pairs = user_pairs(rg, min_score=min_score)
+    else:
+        UserLink.delete_users([int(u_id[1:]) for u_id in u_ids])
+        pairs = user_pairs_of(rg, u_ids, min_score=min_score)
 
-        for uid2 in uids:
-            if uid1 == uid2:
-                continue
-
-            m2 = set(rg.user_movies(uid2))
-
-            intersection = m1.intersection(m2)
-            if not intersection:
-                continue
-
-            union = m1.union(m2)
-
-            buddies[uid2] = dict(
-                # Jaccard index
-                j=len(intersection)/float(len(union)),
-                # Common movies count
-                c=len(intersection),
-            )
-
-        links.append(dict(user=user, buddies=buddies))
-
-    chunked_insert(UserLink, links)
+    columns = ("user1", "user2", "score", "count")
+    insert_rows(UserLink, ((columns, rows) for rows in chunks(pairs, 10000)))
+    invalidate_buddy_index()
 
 class Importer(object):
     """
@@ -86,55 +357,169 @@ class Importer(object):
     ``post_import`` methods.
     """
 
-    def __init__(self, directory, verbose=False):
+    def __init__(self, directory, verbose=False, workers=1):
         self.directory = directory
         self.verbose = verbose
+        # number of processes used to parse the dataset, if the importer
+        # supports it
+        self.workers = workers
 
     def log(self, s):
         if self.verbose:
             print "--> %s" % s
 
-    def run(self):
+    def run(self, bulk=False, links_min_score=0, check=False):
+        """
+        Run the import. With ``bulk=True`` the data is loaded with fast but
+        non-durable SQLite settings and without secondary indexes; both are
+        restored once the ratings are imported.
+
+        ``links_min_score`` is the minimal score of the stored user links, see
+        ``create_user_links``.
+
+        With ``check=True`` the values set by ``post_import`` are checked
+        with ``check_post_import`` and its mismatches are returned.
+        """
         self.log("Initializing...")
         self.start()
-        self.log("Importing movies...")
-        self.import_movies()
-        self.log("Importing users...")
-        self.import_users()
-        self.log("Importing ratings...")
-        self.import_ratings()
+        if bulk:
+            self.log("Using bulk-load mode...")
+            with bulk_load([Movie, User, Rating]):
+                self.load()
+        else:
+            self.load()
         self.log("Running post-import tasks...")
         self.post_import()
+        mismatches = None
+        if check:
+            self.log("Checking post-import values...")
+            mismatches = self.check_post_import()
         self.log("Creating user links...")
-        create_user_links(verbose=self.verbose)
+        create_user_links(verbose=self.verbose, min_score=links_min_score)
+        KeyValue.set_key(LINKS_MIN_SCORE_KEY, links_min_score)
+        return mismatches
 
     def start(self):
         init_db()
 
+    def load(self):
+        self.log("Importing movies...")
+        self.import_movies()
+        self.log("Importing users...")
+        self.import_users()
+        self.log("Importing ratings...")
+        self.import_ratings()
+
     def import_movies(self): pass
     def import_users(self): pass
     def import_ratings(self): pass
 
+    def ingest(self, movies=None, users=None, ratings=None, min_score=None):
+        """
+        Add new movies, users and ratings to an already-imported dataset from
+        delta files in the same format as the dataset ones. Movies and users
+        that are already in the DB are skipped; ratings must all be new.
+
+        Only the cached values of the movies and users that got new ratings
+        are updated, as well as the user links of those who got new positive
+        ratings and the cached global ratings graph. User links are computed
+        with ``min_score``; the default is the one used for the import.
+        """
+        self.log("Initializing...")
+        self.start()
+        if movies is not None:
+            self.log("Ingesting movies...")
+            self.ingest_movies(movies)
+            movies_genres_distribution.invalidate()
+        if users is not None:
+            self.log("Ingesting users...")
+            self.ingest_users(users)
+        if ratings is None:
+            return
+
+        self.log("Ingesting ratings...")
+        new_ratings = self.ingest_ratings(ratings)
+
+        self.log("Updating cached values...")
+        User.update_ratings_stats(set(u for u, _, _ in new_ratings))
+        Movie.update_ratings_stats(set(m for _, m, _ in new_ratings))
+
+        self.log("Updating the ratings graph...")
+        update_global_ratings_graph(("u%d" % u, "m%d" % m, r)
+                for u, m, r in new_ratings)
+
+        if min_score is None:
+            min_score = KeyValue.get_key(LINKS_MIN_SCORE_KEY, 0)
+
+        self.log("Updating user links...")
+        create_user_links(verbose=self.verbose, min_score=min_score,
+                u_ids=set("u%d" % u for u, _, r in new_ratings
+                    if r >= POSITIVE_RATING))
+
+    def ingest_movies(self, filename): pass
+    def ingest_users(self, filename): pass
+
+    def ingest_ratings(self, filename):
+        """
+        This should be overridden by children classes to insert the ratings
+        of the given file and return them as a list of ``(user_id, movie_id,
+        rating)`` tuples.
+        """
+        return []
+
     def post_import(self):
+        User.update_ratings_stats()
+        Movie.update_ratings_stats()
+
+    def check_post_import(self):
+        """
+        Re-compute the values set by ``post_import`` one user and one movie at
+        a time and return a list of ``(object, field, expected, actual)``
+        tuples for those that differ from the database. This is slow; it's
+        meant to be used to check the aggregate queries on small datasets.
+        """
+        mismatches = []
+
         for u in User.select():
-            self.user_post_import(u)
+            count, first_rating_date = self.user_stats(u)
+            if u.ratings_count != count:
+                mismatches.append((u, "ratings_count", count,
+                    u.ratings_count))
+            # users with no ratings get the date at which post_import ran
+            if count and u.first_rating_date != first_rating_date:
+                mismatches.append((u, "first_rating_date",
+                    first_rating_date, u.first_rating_date))
 
         for m in Movie.select():
-            self.movie_post_import(m)
+            count, average_rating = self.movie_stats(m)
+            if m.ratings_count != count:
+                mismatches.append((m, "ratings_count", count,
+                    m.ratings_count))
+            if count and m.average_rating != int(average_rating):
+                mismatches.append((m, "average_rating", int(average_rating),
+                    m.average_rating))
+
+        return mismatches
 
-    def movie_post_import(self, movie):
+    def movie_stats(self, movie):
+        """
+        Return the ratings count and the average rating of a movie. The latter
+        is ``None`` if the movie has no rating.
+        """
         count = 0
         ratings_sum = 0
         for r in movie.ratings:
             count += 1
             ratings_sum += r.rating
 
-        movie.ratings_count = count
         if count > 0:
-            movie.average_rating = ratings_sum/float(count)
-        movie.save()
+            return count, ratings_sum/float(count)
+        return count, None
 
-    def user_post_import(self, user):
+    def user_stats(self, user):
+        """
+        Return the ratings count and the first rating date of an user.
+        """
         count = 0
         first_rating_date = datetime.now()
         for r in user.ratings:
@@ -142,13 +527,30 @@ class Importer(object):
             if r.date < first_rating_date:
                 first_rating_date = r.date
 
-        user.ratings_count = count
-        user.first_rating_date = first_rating_date
-        user.save()
+        return count, first_rating_date
 
 
 class MlImporter(Importer):
-    """Common parent class for MovieLens importers"""
+    """
+    Common parent class for MovieLens importers.
+
+    The directory can also be the dataset's zip archive, in which case its
+    files are read from the archive without extracting it.
+
+    With ``workers > 1`` the files are split in byte ranges that are parsed by
+    that many processes while the current one inserts the resulting rows in
+    the same order as a serial import would.
+    """
+
+    # Set this to True if the users file may contain the same user more than
+    # once. Only the first occurrence of each user is kept.
+    unique_users = False
+
+    # zip codes lookups, shared by all importers
+    zip_codes = ZipCodeResolver(zcdb)
+
+    # Encoding of the dataset files
+    encoding = "iso-8859-1"
 
     def movies_filename(self):
         """
@@ -192,36 +594,181 @@ class MlImporter(Importer):
         """
         pass
 
+    def filename(self, kind):
+        """
+        Return the filename to use to read ``kind``, which is one of
+        ``"movies"``, ``"users"``, or ``"ratings"``.
+        """
+        return {
+            "movies": self.movies_filename,
+            "users": self.users_filename,
+            "ratings": self.ratings_filename,
+        }[kind]()
+
+    def unique(self, kind):
+        """
+        Test if only the first occurrence of each item of the given kind must
+        be kept.
+        """
+        return kind == "users" and self.unique_users
+
+    def parse_item(self, kind, line):
+        """
+        Parse a line of the given kind and return it as a dict ready to be
+        inserted.
+        """
+        if kind == "movies":
+            m = self.parse_movie(line)
+            return m._data if m is not None else None
+
+        if kind == "users":
+            return self.parse_user_dict(line)
+
+        return self.parse_rating_dict(line)
+
+    def parse_items(self, kind, lines):
+        """
+        Lazily parse lines of the given kind, like ``parse_item``. Lines that
+        are parsed as ``None``, such as CSV headers, are skipped. Users also
+        get their city and state from their zip code, if they have one.
+        """
+        items = (self.parse_item(kind, line) for line in lines)
+        items = (item for item in items if item is not None)
+        if kind == "users":
+            items = set_users_dicts_cities(items, self.zip_codes)
+        return items
+
+    def parallel_rows(self, kind, model):
+        """
+        Parse the file of the given kind using ``self.workers`` processes and
+        yield ``(columns, rows)`` groups as returned by ``db_rows``, in the
+        file order.
+        """
+        pool = Pool(self.workers)
+        # we keep a bounded number of pending ranges so that the memory usage
+        # doesn't depend on the file size if the workers are faster than us.
+        pending = deque()
+        seen = set()
+        pk = model._meta.primary_key.db_column
+
+        def results(res):
+            for columns, rows in res.get():
+                if self.unique(kind):
+                    idx = columns.index(pk)
+                    rows = [r for r in rows if r[idx] not in seen]
+                    seen.update(r[idx] for r in rows)
+                yield columns, rows
+
+        filename = self.filename(kind)
+        if archive_member(filename):
+            # archive members can't be read from an arbitrary position so we
+            # read them here and send their content to the workers
+            tasks = ((_parse_block, (self, kind, model, block))
+                    for block in raw_blocks(filename))
+        else:
+            tasks = ((_parse_range, (self, kind, model, start, end))
+                    for start, end in byte_ranges(filename))
+
+        try:
+            for fn, args in tasks:
+                pending.append(pool.apply_async(fn, (args,)))
+
+                if len(pending) >= 2 * self.workers:
+                    for group in results(pending.popleft()):
+                        yield group
+
+            while pending:
+                for group in results(pending.popleft()):
+                    yield group
+        finally:
+            pool.terminate()
+
+    def iter_items(self, kind, model, filename=None):
+        """
+        Lazily parse items of the given kind from their file, or from
+        ``filename`` if it's given.
+        """
+        if filename is None:
+            filename = self.filename(kind)
+        items = self.parse_items(kind, read_lines(filename, self.encoding))
+        if self.unique(kind):
+            items = unique_by_pk(model, items)
+        return items
+
     def import_movies(self):
+        if self.workers > 1:
+            insert_rows(Movie, self.parallel_rows("movies", Movie))
+            return
+
         with db.atomic():
-            with open(self.movies_filename()) as f:
-                for line in f:
-                    line = fix_encoding(line).strip()
-                    m = self.parse_movie(line)
+            for line in read_lines(self.movies_filename(), self.encoding):
+                m = self.parse_movie(line)
+                if m is not None:
                     m.save(force_insert=True)
 
-    def import_users(self):
-        items = []
-        with open(self.users_filename()) as f:
-            for line in f:
-                line = fix_encoding(line).strip()
-                item = self.parse_user_dict(line)
+    def iter_users(self):
+        """
+        Lazily parse users from the users file.
+        """
+        return self.iter_items("users", User)
 
-                if "zip_code" in item:
-                    set_user_dict_city(item)
-                items.append(item)
+    def iter_ratings(self):
+        """
+        Lazily parse ratings from the ratings file.
+        """
+        return self.iter_items("ratings", Rating)
 
-        chunked_insert(User, items, 100)
+    def import_users(self):
+        if self.workers > 1:
+            insert_rows(User, self.parallel_rows("users", User))
+        else:
+            chunked_insert(User, self.iter_users())
+            # lookups are done by the workers in parallel mode
+            self.log_lookups()
+
+    def log_lookups(self):
+        zc = self.zip_codes
+        self.log("Zip codes lookups: %d hits, %d misses" % (zc.hits,
+            zc.misses))
+        self.log("Occupations lookups: %d hits, %d misses" % (
+            OccupationField.hits, OccupationField.misses))
 
     def import_ratings(self):
-        items = []
-        with open(self.ratings_filename()) as f:
-            for line in f:
-                line = fix_encoding(line).strip()
-                item = self.parse_rating_dict(line)
-                items.append(item)
+        if self.workers > 1:
+            insert_rows(Rating, self.parallel_rows("ratings", Rating))
+        else:
+            chunked_insert(Rating, self.iter_ratings())
+
+    def new_items(self, kind, model, filename):
+        """
+        Lazily parse items of the given kind from ``filename``, skipping those
+        whose primary key is already in the DB.
+        """
+        pk = model._meta.primary_key
+        for chunk in chunks(self.iter_items(kind, model, filename), 500):
+            ids = [int(item[pk.name]) for item in chunk]
+            existing = set(i for (i,) in
+                    model.select(pk).where(pk << ids).tuples())
+            for item in chunk:
+                if int(item[pk.name]) not in existing:
+                    yield item
 
-        chunked_insert(Rating, items)
+    def ingest_movies(self, filename):
+        chunked_insert(Movie, self.new_items("movies", Movie, filename))
+
+    def ingest_users(self, filename):
+        chunked_insert(User, self.new_items("users", User, filename))
+
+    def ingest_ratings(self, filename):
+        ratings = []
+
+        def items():
+            for item in self.iter_items("ratings", Rating, filename):
+                ratings.append((item["user"], item["movie"], item["rating"]))
+                yield item
+
+        chunked_insert(Rating, items())
+        return ratings
 
 
 class Ml100kImporter(MlImporter):
@@ -229,7 +776,7 @@ class Ml100kImporter(MlImporter):
 
     def parse_date(self, s):
         # format: 01-Jan-1995
-        return datetime.strptime(s, "%d-%b-%Y") if s else None
+        return datetime.strptime(s, "%d-%b-%Y").date() if s else None
 
     def movies_filename(self): return "%s/u.item" % self.directory
     def users_filename(self): return "%s/u.user" % self.directory
@@ -312,17 +859,103 @@ class Ml1mImporter(MlImporter):
         return dict(user=int(u_id), movie=int(m_id), rating=float(rating),
                 date=parse_ts(ts))
 
+OccupationField.prefill(Ml1mImporter.occupations.values())
+
 class Ml10mImporter(Ml1mImporter):
     """An importer for the ml-10m dataset"""
 
     # There are no user info in this dataset, so we extract the user ids from
     # the ratings file
-    def import_users(self):
-        users = {}
+    unique_users = True
+
+    def users_filename(self): return self.ratings_filename()
+
+    def parse_user_dict(self, line):
+        u_id, _ = line.split("::", 1)
+        return dict(user_id=u_id)
+
+    def ingest_ratings(self, filename):
+        self.ingest_users(filename)
+        return super(Ml10mImporter, self).ingest_ratings(filename)
+
+
+class Ml20mImporter(Ml10mImporter):
+    """
+    An importer for the ml-20m dataset. Its files are UTF-8 CSVs with a
+    header line; movies links to IMDb and TMDb are in a separate file.
+    """
+
+    encoding = "utf8"
 
-        with open(self.ratings_filename()) as f:
-            for line in f:
-                u_id, _ = fix_encoding(line).strip().split("::", 1)
-                users[u_id] = dict(user_id=u_id)
+    def movies_filename(self): return "%s/movies.csv" % self.directory
+    def ratings_filename(self): return "%s/ratings.csv" % self.directory
+    def links_filename(self): return "%s/links.csv" % self.directory
 
-        chunked_insert(User, users.values(), 100)
+    def parse_movie(self, line):
+        # titles may contain commas, in which case they're quoted
+        m_id, title, genres = next(csv.reader([line]))
+        if m_id == "movieId":
+            # header
+            return None
+
+        m = Movie(movie_id=int(m_id), title=title)
+        m.set_genres(genres.split("|"))
+        return m
+
+    def parse_user_dict(self, line):
+        u_id, _ = line.split(",", 1)
+        if u_id == "userId":
+            return None
+        return dict(user_id=u_id)
+
+    def parse_rating_dict(self, line):
+        u_id, m_id, rating, ts = line.split(",")
+        if u_id == "userId":
+            return None
+        return dict(user=int(u_id), movie=int(m_id), rating=float(rating),
+                date=parse_ts(ts))
+
+    def parse_links(self, line):
+        """
+        Parse a line from the links file and return a ``(imdb_url, tmdb_url,
+        movie_id)`` tuple, or ``None`` for the header.
+        """
+        m_id, imdb_id, tmdb_id = line.split(",")
+        if m_id == "movieId":
+            return None
+
+        imdb_url = "http://www.imdb.com/title/tt%s/" % imdb_id if imdb_id \
+                else None
+        tmdb_url = "https://www.themoviedb.org/movie/%s" % tmdb_id if tmdb_id \
+                else None
+        return imdb_url, tmdb_url, int(m_id)
+
+    def import_movies(self):
+        super(Ml20mImporter, self).import_movies()
+        self.import_links(self.links_filename())
+
+    def ingest_movies(self, filename):
+        super(Ml20mImporter, self).ingest_movies(filename)
+        # links of the new movies are expected to be in the dataset's links
+        # file, next to the original one
+        links = os.path.join(os.path.dirname(filename), "links.csv")
+        if os.path.exists(links):
+            self.import_links(links)
+
+    def import_links(self, filename):
+        """
+        Set the IMDb and TMDb URLs of the movies from a links file.
+        """
+        links = (self.parse_links(line)
+                for line in read_lines(filename, self.encoding))
+        links = (link for link in links if link is not None)
+
+        with db.atomic():
+            cursor = db.get_cursor()
+            for chunk in chunks(links, 10000):
+                cursor.executemany(
+                    "UPDATE movie SET imdb_url = ?, tmdb_url = ? "
+                    "WHERE movie_id = ? AND imdb_url IS NULL", chunk)
+
+class Ml25mImporter(Ml20mImporter):
+    """An importer for the ml-25m dataset, which uses the ml-20m layout"""
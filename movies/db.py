@@ -3,10 +3,12 @@
 import json
 import pickle
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
 
 import peewee
 from peewee import IntegerField, CharField, DateField, DateTimeField
-from peewee import BooleanField, FixedCharField, ForeignKeyField, TextField
+from peewee import BooleanField, FixedCharField, ForeignKeyField
 from peewee import FloatField
 from playhouse.sqlite_ext import SqliteExtDatabase
 
@@ -36,17 +38,28 @@ GENRES = OrderedDict((
 
 db = SqliteExtDatabase("movies.db")
 
+@contextmanager
+def temp_ids(name, ids):
+    """
+    Context manager that fills a temporary table ``name`` with a single
+    ``id`` column holding ``ids``. It's useful to restrict a query to a set of
+    ids without hitting SQLite's host parameters limit. The table is dropped
+    on exit.
+    """
+    db.execute_sql("DROP TABLE IF EXISTS temp.%s" % name)
+    db.execute_sql("CREATE TEMP TABLE %s (id INTEGER PRIMARY KEY)" % name)
+    try:
+        cursor = db.get_cursor()
+        cursor.executemany("INSERT OR IGNORE INTO temp.%s VALUES (?)" % name,
+                ((i,) for i in ids))
+        yield
+    finally:
+        db.execute_sql("DROP TABLE temp.%s" % name)
+
 class BaseModel(peewee.Model):
     class Meta:
         database = db
 
-class JSONField(TextField):
-    def db_value(self, value):
-        return super(JSONField, self).db_value(json.dumps(value))
-
-    def python_value(self, value):
-        return json.loads(super(JSONField, self).python_value(value))
-
 class OccupationField(CharField):
     """
     A text field that uniformize the occupation
@@ -59,12 +72,30 @@ class OccupationField(CharField):
         "librarian", "marketing", "none", "other", "programmer", "retired",
         "salesman", "scientist", "student", "technician", "writer"))
 
-    def _normalize(self, value):
+    # ml-1m aliases
+    _ALIASES = {
+        "doctor/health care": "healthcare",
+        "administrator": "clerical/admin",
+        "sales/marketing": "salesman",
+        "unemployed": "none",
+    }
+
+    # Normalization table: raw value -> normalized value. It's pre-filled
+    # with the occupations of the known datasets (see ``prefill``) and grows
+    # with other values as they're normalized.
+    _normalized = {}
+
+    # lookups in the normalization table
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def _compute_normalized(cls, value):
         value = value.lower().strip()
-        if value in OccupationField._OCCUPATIONS:
+        if value in cls._OCCUPATIONS:
             return value
 
-        for occupation in OccupationField._OCCUPATIONS:
+        for occupation in cls._OCCUPATIONS:
             # e.g. "academic/educator" -> "educator"
             if (value.startswith(occupation + "/") or
                     value.endswith("/" + occupation)):
@@ -74,22 +105,39 @@ class OccupationField(CharField):
         if value.endswith(" student"):
             return "student"
 
-        # ml-1m aliases
-        aliases = {
-            "doctor/health care": "healthcare",
-            "administrator": "clerical/admin",
-            "sales/marketing": "salesman",
-            "unemployed": "none",
-        }
-
-        if value in aliases:
-            return aliases[value]
+        if value in cls._ALIASES:
+            return cls._ALIASES[value]
 
         return "other"
 
+    @classmethod
+    def prefill(cls, values):
+        """
+        Add the given raw values to the normalization table, e.g. all the
+        occupations of a dataset.
+        """
+        for value in values:
+            cls._normalized[value] = cls._compute_normalized(value)
+
+    def _normalize(self, value):
+        if value is None:
+            return None
+
+        cls = OccupationField
+        try:
+            normalized = cls._normalized[value]
+            cls.hits += 1
+        except KeyError:
+            normalized = cls._normalized[value] = cls._compute_normalized(
+                    value)
+            cls.misses += 1
+        return normalized
+
     def db_value(self, value):
         return super(OccupationField, self).db_value(self._normalize(value))
 
+OccupationField.prefill(OccupationField._OCCUPATIONS)
+
 class Movie(BaseModel):
     movie_id = IntegerField(unique=True, primary_key=True)
     title = CharField()
@@ -176,6 +224,47 @@ class Movie(BaseModel):
         for g, v in zip(GENRES, genres):
             setattr(self, Movie.genre_attr(g), bool(int(v)))
 
+    @classmethod
+    def update_ratings_stats(cls, movie_ids=None):
+        """
+        Update the cached ``ratings_count`` and ``average_rating`` of all
+        movies, or only the given ones, with one aggregate query over the
+        ratings. The average rating of movies with no rating is left
+        untouched.
+        """
+        if movie_ids is None:
+            cls._update_ratings_stats("")
+            return
+
+        with temp_ids("stats_movie_ids", movie_ids):
+            cls._update_ratings_stats(
+                    "WHERE movie_id IN (SELECT id FROM temp.stats_movie_ids)")
+
+    @classmethod
+    def _update_ratings_stats(cls, where):
+        with db.atomic():
+            db.execute_sql("DROP TABLE IF EXISTS temp.movie_stats")
+            db.execute_sql("""
+                CREATE TEMP TABLE movie_stats (
+                    movie_id INTEGER PRIMARY KEY, n INTEGER, average REAL)
+            """)
+            db.execute_sql("""
+                INSERT INTO movie_stats
+                SELECT movie_id, COUNT(*), AVG(rating)
+                FROM rating %s GROUP BY movie_id
+            """ % where)
+            # average_rating is an IntegerField; CAST truncates like int()
+            db.execute_sql("""
+                UPDATE movie SET
+                ratings_count = COALESCE((SELECT n FROM movie_stats s
+                    WHERE s.movie_id = movie.movie_id), 0),
+                average_rating = COALESCE((SELECT CAST(average AS INTEGER)
+                    FROM movie_stats s WHERE s.movie_id = movie.movie_id),
+                    average_rating)
+                %s
+            """ % where)
+            db.execute_sql("DROP TABLE temp.movie_stats")
+
     def raters(self):
         return (User.select()
                     .join(Rating, on=Rating.user)
@@ -212,6 +301,45 @@ class User(BaseModel):
             u_id = u_id[1:]
         return User.get(User.user_id == int(u_id))
 
+    @classmethod
+    def update_ratings_stats(cls, user_ids=None):
+        """
+        Update the cached ``ratings_count`` and ``first_rating_date`` of all
+        users, or only the given ones, with one aggregate query over the
+        ratings. Users with no rating get the current date as their first
+        rating date.
+        """
+        if user_ids is None:
+            cls._update_ratings_stats("")
+            return
+
+        with temp_ids("stats_user_ids", user_ids):
+            cls._update_ratings_stats(
+                    "WHERE user_id IN (SELECT id FROM temp.stats_user_ids)")
+
+    @classmethod
+    def _update_ratings_stats(cls, where):
+        with db.atomic():
+            db.execute_sql("DROP TABLE IF EXISTS temp.user_stats")
+            db.execute_sql("""
+                CREATE TEMP TABLE user_stats (
+                    user_id INTEGER PRIMARY KEY, n INTEGER, first DATETIME)
+            """)
+            db.execute_sql("""
+                INSERT INTO user_stats
+                SELECT user_id, COUNT(*), MIN(date)
+                FROM rating %s GROUP BY user_id
+            """ % where)
+            db.execute_sql("""
+                UPDATE user SET
+                ratings_count = COALESCE((SELECT n FROM user_stats s
+                    WHERE s.user_id = user.user_id), 0),
+                first_rating_date = COALESCE((SELECT first FROM user_stats s
+                    WHERE s.user_id = user.user_id), ?)
+                %s
+            """ % where, (datetime.now(),))
+            db.execute_sql("DROP TABLE temp.user_stats")
+
     def genres_ratings(self):
         return json.loads(self.genres_json)
 
@@ -246,12 +374,37 @@ class Rating(BaseModel):
 
 class UserLink(BaseModel):
     """
-    An user link to their "buddies" in the projected graph. This is used to
-    cache the graph in the DB
+    A link between two users ("buddies") in the projected graph. This is used
+    to cache the graph in the DB. There's one row per unordered pair of users,
+    with ``user1 < user2``.
     """
-    user = ForeignKeyField(User, related_name="links")
-    # Mapping of user_id -> {j: jaccard_index, c: common_movies_count}
-    buddies = JSONField(default={})
+    user1 = IntegerField()
+    user2 = IntegerField()
+    # Jaccard index of the two users' movies
+    score = FloatField()
+    # Common movies count
+    count = IntegerField()
+
+    class Meta:
+        indexes = (
+            (("user1", "user2"), True),
+            # covering index for threshold queries
+            (("score", "user1", "user2"), False),
+            # used to remove the links of some users
+            (("user2",), False),
+        )
+
+    @classmethod
+    def delete_users(cls, user_ids):
+        """
+        Delete all the links of the given users.
+        """
+        with temp_ids("links_user_ids", user_ids):
+            db.execute_sql("""
+                DELETE FROM userlink
+                WHERE user1 IN (SELECT id FROM temp.links_user_ids)
+                OR user2 IN (SELECT id FROM temp.links_user_ids)
+            """)
 
 class KeyValue(BaseModel):
     """
@@ -298,3 +451,85 @@ for g, name in GENRES.items():
 def init_db():
     db.connect()
     db.create_tables([Movie, User, Rating, UserLink, KeyValue], True)
+
+def max_variables():
+    """
+    Return the maximum number of host parameters SQLite accepts in a single
+    statement. This is the one SQLite was compiled with if it says so, or the
+    default of its version otherwise.
+    """
+    # https://www.sqlite.org/limits.html#max_variable_number
+    for option, in db.execute_sql("PRAGMA compile_options"):
+        name, _, value = option.partition("=")
+        if name == "MAX_VARIABLE_NUMBER" and value.isdigit():
+            return int(value)
+
+    version = db.execute_sql("SELECT sqlite_version()").fetchone()[0]
+    if tuple(int(n) for n in version.split(".")[:3]) >= (3, 32, 0):
+        return 32766
+    return 999
+
+def max_insert_rows(model):
+    """
+    Return the maximum number of rows of ``model`` that can be inserted with
+    one multi-rows ``INSERT`` statement.
+    """
+    return max(1, max_variables() // len(model._meta.sorted_fields))
+
+# Number of rows fetched at once by ``fetch_batches``
+FETCH_SIZE = 100000
+
+def fetch_batches(query, size=FETCH_SIZE):
+    """
+    Execute ``query`` and yield its rows by lists of at most ``size`` raw
+    tuples. This is a lot faster than iterating over the query when there are
+    millions of rows, because no model instance is created.
+    """
+    cursor = db.execute_sql(*query.sql())
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+# Pragmas used while bulk-loading data. They trade durability for speed: if
+# the process crashes during the import the database must be re-created.
+BULK_LOAD_PRAGMAS = (
+    ("journal_mode", "MEMORY"),
+    ("synchronous", "OFF"),
+    ("temp_store", "MEMORY"),
+    # in KiB when negative
+    ("cache_size", -200000),
+)
+
+@contextmanager
+def bulk_load(models):
+    """
+    Context manager to quickly load a lot of data in the tables of the given
+    models. It sets import-time pragmas and drops the secondary indexes of
+    these tables, then re-creates the indexes and restores the previous
+    pragmas on exit.
+    """
+    previous = []
+    for name, value in BULK_LOAD_PRAGMAS:
+        current = db.execute_sql("PRAGMA %s" % name).fetchone()[0]
+        previous.append((name, current))
+        db.execute_sql("PRAGMA %s = %s" % (name, value))
+
+    indexes = []
+    for model in models:
+        for index in db.get_indexes(model._meta.db_table):
+            # automatic indexes (e.g. for primary keys) have no SQL and can't
+            # be dropped
+            if index.sql:
+                indexes.append(index)
+                db.execute_sql('DROP INDEX "%s"' % index.name)
+
+    try:
+        yield
+    finally:
+        for index in indexes:
+            db.execute_sql(index.sql)
+
+        for name, value in previous:
+            db.execute_sql("PRAGMA %s = %s" % (name, value))
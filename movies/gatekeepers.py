@@ -0,0 +1,179 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Gatekeepers of all the users, computed from the ratings graph.
+
+For a user ``u`` the co-fans are the other users who liked at least one movie
+``u`` liked. A co-fan is a gatekeeper of a movie for ``u`` if at most
+``gatekeepers_count`` co-fans of ``u`` liked it (see
+``RatingsGraph.user_movies_gatekeepers``). For each block of users we list
+the co-fans of each user, then count how many of them liked each movie with
+their movies; only the visible edges of the graph are expanded, and the
+number of entries is bounded by users and movies, not by edges. This uses
+the same incidence structure as the users similarities.
+"""
+
+import numpy as np
+
+from .graph import expand_ranges
+from .similarity import Incidence, MAX_BLOCK_ENTRIES, blocks
+
+__all__ = ["users_gatekeepers", "gatekeepers_table"]
+
+def _gatekeepers(inc, users, max_count, max_entries):
+    """
+    Yield ``(u, gatekeepers, movies, counts)`` for each user index of
+    ``users``, where ``gatekeepers[i]`` is a gatekeeper of the movie
+    ``movies[i]`` for ``u`` and ``counts[i]`` is the number of co-fans of
+    ``u`` who liked this movie. Only the movies liked by at most
+    ``max_count`` co-fans are kept. The arrays are sorted by gatekeeper then
+    by movie.
+    """
+    n_users, n_movies = len(inc.users), len(inc.movies)
+    user_degrees = inc.user_degrees()
+    movie_degrees = inc.movie_degrees()
+
+    # the number of entries of the co-fans expansion for each user
+    costs = np.zeros(len(users), dtype=np.int64)
+    for i, u in enumerate(users):
+        ms = inc.user_idx[inc.user_start[u]:inc.user_end[u]]
+        costs[i] = movie_degrees[ms].sum()
+
+    for block in blocks(costs, n_users, max_entries):
+        block = users[block]
+        cofans = inc.co_fans(block) > 0
+        cofans[np.arange(len(block)), block] = False
+
+        # most users are often co-fans of each other: the co-fans of a user
+        # who liked each movie are then counted as its fans minus the other
+        # users (including the user themselves) who liked it, if these ones
+        # have fewer movies in total
+        costs = cofans.dot(user_degrees)
+        others_costs = user_degrees.sum() - costs
+        others = others_costs < costs
+        expanded = cofans.copy()
+        expanded[others] = ~cofans[others]
+        costs = np.where(others, others_costs, costs)
+
+        rows, fans = np.nonzero(expanded)
+        limits = np.searchsorted(rows, np.arange(len(block) + 1))
+
+        # the block is split again if the expanded users have too many
+        # movies
+        for sub in blocks(costs, n_movies, max_entries):
+            first = sub[0]
+            s = slice(limits[first], limits[sub[-1] + 1])
+
+            # counts[i, m] is the number of co-fans of block[first + i] who
+            # liked m
+            starts = inc.user_start[fans[s]]
+            lengths = inc.user_end[fans[s]] - starts
+            cells = np.repeat((rows[s] - first) * n_movies, lengths)
+            cells += inc.user_idx[expand_ranges(starts, lengths)]
+            counts = np.bincount(cells, minlength=len(sub) * n_movies)
+            counts = counts.reshape((len(sub), n_movies))
+            counts[others[sub]] = movie_degrees - counts[others[sub]]
+
+            for i, gatekeepers, movies, gt_counts in _gatekept(inc, cofans,
+                    first, counts, max_count):
+                yield block[first + i], gatekeepers, movies, gt_counts
+
+def _gatekept(inc, cofans, first, counts, max_count):
+    """
+    Yield ``(i, gatekeepers, movies, counts)`` for each row ``i`` of
+    ``counts``, the co-fans counts of the users ``first + i`` of the block
+    whose ``cofans`` matrix is given. See ``_gatekeepers``.
+    """
+    n_rows = len(counts)
+    rows, movies = np.nonzero((counts > 0) & (counts <= max_count))
+    counts = counts[rows, movies]
+
+    # the co-fans who liked each one of these movies
+    starts = inc.movie_start[movies]
+    lengths = inc.movie_end[movies] - starts
+    fans = inc.movie_idx[expand_ranges(starts, lengths)]
+    rows = np.repeat(rows, lengths)
+    movies = np.repeat(movies, lengths)
+    counts = np.repeat(counts, lengths)
+
+    keep = cofans[first + rows, fans]
+    rows, fans, movies = rows[keep], fans[keep], movies[keep]
+    counts = counts[keep]
+
+    order = np.lexsort((movies, fans, rows))
+    rows, fans = rows[order], fans[order]
+    movies, counts = movies[order], counts[order]
+
+    limits = np.searchsorted(rows, np.arange(n_rows + 1))
+    for i in range(n_rows):
+        s = slice(limits[i], limits[i + 1])
+        yield i, fans[s], movies[s], counts[s]
+
+def users_gatekeepers(rg, u_ids=None, gatekeepers_count=1,
+        max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Yield ``(u_id, gatekeepers)`` pairs for each user of ``u_ids`` (default:
+    all the users of the graph), in order. ``gatekeepers`` is a ``dict``
+    mapping each gatekeeper of ``u_id`` to the movies they gatekeep, like
+    ``RatingsGraph.user_movies_gatekeepers`` returns.
+
+    ``max_entries`` bounds the size of the intermediary arrays.
+    """
+    inc = Incidence(rg)
+    if u_ids is None:
+        u_ids = rg.users()
+
+    # users that are in the graph, in the requested order
+    known = np.array([inc.user_index[u] for u in u_ids if u in inc.user_index],
+            dtype=np.int64)
+
+    gks = _gatekeepers(inc, known, gatekeepers_count, max_entries)
+    for u_id in u_ids:
+        if u_id not in inc.user_index:
+            yield u_id, {}
+            continue
+
+        _, fans, movies, _ = next(gks)
+        gatekeepers = {}
+        if len(fans):
+            # split the movies by gatekeeper
+            limits = np.flatnonzero(np.diff(fans)) + 1
+            for gt, ms in zip(fans[np.r_[0, limits]].tolist(),
+                    np.split(movies, limits)):
+                gatekeepers[inc.users[gt]] = [inc.movies[m]
+                        for m in ms.tolist()]
+        yield u_id, gatekeepers
+
+def gatekeepers_table(rg, u_ids=None, max_count=1,
+        max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Return the gatekeepers of the given users (default: all the users of the
+    graph) as four arrays ``(users, gatekeepers, movies, counts)``: for each
+    ``i``, ``gatekeepers[i]`` is a gatekeeper of ``movies[i]`` for
+    ``users[i]`` and ``counts[i]`` is the number of co-fans of ``users[i]``
+    who liked the movie. Users and movies are given by their integer ids.
+
+    All the gatekeepers for ``max_count`` are returned; those for any lower
+    ``gatekeepers_count`` are the ones with ``counts <= gatekeepers_count``.
+    """
+    inc = Incidence(rg)
+    if u_ids is None:
+        u_ids = rg.users()
+
+    known = np.array(sorted(set(inc.user_index[u] for u in u_ids
+        if u in inc.user_index)), dtype=np.int64)
+
+    columns = ([], [], [], [])
+    for u, fans, movies, counts in _gatekeepers(inc, known, max_count,
+            max_entries):
+        for column, values in zip(columns, (np.repeat(u, len(fans)), fans,
+                movies, counts)):
+            column.append(values)
+
+    if not len(known):
+        return tuple(np.zeros(0, dtype=np.int64) for _ in columns)
+
+    users, fans, movies, counts = [np.concatenate(c) for c in columns]
+    movie_ids = np.array([int(m[1:]) for m in inc.movies], dtype=np.int64)
+    return (inc.user_ids[users], inc.user_ids[fans], movie_ids[movies],
+            counts)
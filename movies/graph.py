@@ -0,0 +1,688 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compact bipartite users/movies graph.
+
+Nodes are identified by their integer ids (the ones in the DB) and the edges
+are stored as CSR (compressed sparse rows) NumPy arrays in both directions:
+the movies of each user and the fans of each movie. This uses a few bytes per
+edge instead of the dict-of-dicts adjacency of a networkx graph.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+import networkx as nx
+import numpy as np
+
+__all__ = ["BipartiteGraph", "expand_ranges"]
+
+# dtype of the nodes ids and of the neighbours indexes
+ID_DTYPE = np.int32
+# dtype of the offsets, which can go up to the number of edges
+PTR_DTYPE = np.int64
+# dtype of the ratings; they are multiples of 0.5 so this is exact
+RATING_DTYPE = np.float32
+
+# Maximum number of neighbours gathered at once by ``ego_nodes``
+MAX_GATHER_ENTRIES = 2**22
+
+# Snapshot files start with the magic string, the format version and the
+# length of a JSON header describing the arrays, which follow it. Increment
+# the version when the format changes.
+SNAPSHOT_MAGIC = "MLRGRAPH"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_PREFIX = struct.Struct("<8sII")
+# arrays are aligned on cache lines
+SNAPSHOT_ALIGNMENT = 64
+
+def expand_ranges(starts, lengths):
+    """
+    Return the concatenation of ``range(s, s+l)`` for each ``s``, ``l`` pair
+    from ``starts`` and ``lengths``.
+
+    >>> expand_ranges(np.array([3, 10]), np.array([2, 3])).tolist()
+    [3, 4, 10, 11, 12]
+    """
+    total = lengths.sum()
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return (np.repeat(starts - offsets, lengths) +
+            np.arange(total, dtype=np.int64))
+
+def csr_offsets(idx, n):
+    """
+    Return the CSR offsets array for the sorted row indexes ``idx`` of a
+    matrix with ``n`` rows.
+    """
+    ptr = np.zeros(n + 1, dtype=PTR_DTYPE)
+    np.cumsum(np.bincount(idx, minlength=n), out=ptr[1:])
+    return ptr
+
+class BipartiteGraph(object):
+    """
+    An immutable bipartite graph between users and movies.
+
+    ``user_ids`` and ``movie_ids`` are the sorted ids of the nodes. The movies
+    of the user at index ``i`` are at the indexes
+    ``user_idx[user_start[i]:user_end[i]]`` of ``movie_ids``;
+    ``movie_start``, ``movie_end`` and ``movie_idx`` give the fans of each
+    movie the same way. ``user_ptr`` and ``movie_ptr`` are the offsets of all
+    the stored edges: ``user_start`` is ``user_ptr[:-1]`` and ``user_end`` is
+    ``user_ptr[1:]`` unless the graph is a threshold view (see below).
+
+    A graph can have the rating of each edge, in ``user_ratings`` and
+    ``movie_ratings`` (aligned with ``user_idx`` and ``movie_idx``). The
+    edges of each node are then sorted by decreasing rating, so the ones with
+    a rating of at least ``t`` come first. ``at_least(t)`` uses that to return
+    a view of the graph that shares all its arrays and only has its own
+    ``user_end`` and ``movie_end``. The nodes of a view are the ones that have
+    at least one edge in it.
+
+    Use ``from_edges`` to build one.
+    """
+
+    # arrays stored in snapshots
+    ARRAYS = ("user_ids", "movie_ids", "user_ptr", "user_idx", "user_ratings",
+            "movie_ptr", "movie_idx", "movie_ratings")
+
+    def __init__(self, user_ids, movie_ids, user_ptr, user_idx, movie_ptr,
+            movie_idx, user_ratings=None, movie_ratings=None,
+            min_rating=None):
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.user_ptr = user_ptr
+        self.user_idx = user_idx
+        self.user_ratings = user_ratings
+        self.movie_ptr = movie_ptr
+        self.movie_idx = movie_idx
+        self.movie_ratings = movie_ratings
+        self.min_rating = min_rating
+
+        self.user_start = user_ptr[:-1]
+        self.movie_start = movie_ptr[:-1]
+        if min_rating is None:
+            self.user_end = user_ptr[1:]
+            self.movie_end = movie_ptr[1:]
+        else:
+            self.user_end = prefix_ends(user_ptr, user_ratings, min_rating)
+            self.movie_end = prefix_ends(movie_ptr, movie_ratings,
+                    min_rating)
+
+        # the degrees and the nodes are computed once; the nodes sorted by
+        # degree only when they're first asked for
+        self._user_degrees = self.user_end - self.user_start
+        self._movie_degrees = self.movie_end - self.movie_start
+        if min_rating is None:
+            self._users = user_ids
+            self._movies = movie_ids
+        else:
+            self._users = user_ids[self._user_degrees > 0]
+            self._movies = movie_ids[self._movie_degrees > 0]
+        self._users_by_degree = None
+        self._movies_by_degree = None
+        self._movie_popularities = None
+
+    @classmethod
+    def from_edges(cls, users, movies, ratings=None, user_ids=(),
+            movie_ids=()):
+        """
+        Build a graph from the ``users`` and ``movies`` sequences of ids,
+        where ``(users[i], movies[i])`` is an edge with the rating
+        ``ratings[i]``. Ratings are optional. Duplicated edges are ignored.
+        ``user_ids`` and ``movie_ids`` are additional nodes that might not
+        have any edge.
+        """
+        users = np.asarray(users, dtype=ID_DTYPE)
+        movies = np.asarray(movies, dtype=ID_DTYPE)
+
+        user_ids = np.union1d(users, np.asarray(user_ids, dtype=ID_DTYPE))
+        movie_ids = np.union1d(movies, np.asarray(movie_ids, dtype=ID_DTYPE))
+
+        # sort the edges by user then movie and remove the duplicates
+        n_movies = max(len(movie_ids), 1)
+        keys = (np.searchsorted(user_ids, users).astype(np.int64) * n_movies
+                + np.searchsorted(movie_ids, movies))
+        keys, first = np.unique(keys, return_index=True)
+        u = (keys // n_movies).astype(ID_DTYPE)
+        m = (keys % n_movies).astype(ID_DTYPE)
+
+        n_users = len(user_ids)
+        n_movies = len(movie_ids)
+
+        if ratings is None:
+            # transpose the edges to get the fans of each movie
+            order = np.argsort(m, kind="mergesort")
+            return cls(user_ids, movie_ids,
+                    csr_offsets(u, n_users), m,
+                    csr_offsets(m[order], n_movies), u[order])
+
+        r = np.asarray(ratings, dtype=RATING_DTYPE)[first]
+        # the edges of each node are sorted by decreasing rating
+        by_user = np.lexsort((m, -r, u))
+        by_movie = np.lexsort((u, -r, m))
+        return cls(user_ids, movie_ids,
+                csr_offsets(u, n_users), m[by_user],
+                csr_offsets(m[by_movie], n_movies), u[by_movie],
+                r[by_user], r[by_movie])
+
+    @classmethod
+    def from_networkx(cls, g):
+        """
+        Build a graph from a networkx graph with ``"u<id>"`` and
+        ``"m<id>"`` nodes.
+        """
+        users = []
+        movies = []
+        for a, b in g.edges_iter():
+            if a.startswith("m"):
+                a, b = b, a
+            users.append(int(a[1:]))
+            movies.append(int(b[1:]))
+
+        nodes = g.nodes()
+        return cls.from_edges(users, movies,
+                user_ids=[int(n[1:]) for n in nodes if n.startswith("u")],
+                movie_ids=[int(n[1:]) for n in nodes if n.startswith("m")])
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a graph saved with ``save`` and return a ``(graph, meta)`` pair.
+        The file is memory-mapped instead of being read: loading is nearly
+        instant and the processes that load the same file share its pages.
+        The arrays of the graph are read-only. Raise ``ValueError`` if the
+        file is not a snapshot in the current format.
+        """
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(buf) < SNAPSHOT_PREFIX.size:
+            raise ValueError("'%s' is not a graph snapshot" % filename)
+
+        magic, version, header_size = SNAPSHOT_PREFIX.unpack_from(buf)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("'%s' is not a graph snapshot" % filename)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("'%s' has the snapshot version %d instead of %d"
+                    % (filename, version, SNAPSHOT_VERSION))
+
+        start = SNAPSHOT_PREFIX.size
+        header = json.loads(buf[start:start + header_size])
+        data_start = _aligned(start + header_size)
+
+        arrays = {}
+        for name, dtype, length, offset in header["arrays"]:
+            if length == 0:
+                arrays[str(name)] = np.zeros(0, dtype=dtype)
+            else:
+                arrays[str(name)] = np.frombuffer(buf, dtype=dtype,
+                        count=length, offset=data_start + offset)
+
+        graph = cls(min_rating=header["min_rating"], **arrays)
+        return graph, header["meta"]
+
+    def save(self, filename, meta=None):
+        """
+        Save the graph in a snapshot file that can be loaded with ``load``.
+        ``meta`` is an optional JSON-serializable value stored along the
+        graph. The file is written under a temporary name then renamed so
+        that the processes that mapped the previous version of the file keep
+        it intact.
+        """
+        arrays = []
+        offset = 0
+        for name in self.ARRAYS:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            arr = np.ascontiguousarray(arr)
+            arrays.append((name, arr.dtype.str, len(arr), offset, arr))
+            offset = _aligned(offset + arr.nbytes)
+
+        header = json.dumps({
+            "arrays": [a[:4] for a in arrays],
+            "min_rating": self.min_rating,
+            "meta": meta,
+        })
+        data_start = _aligned(SNAPSHOT_PREFIX.size + len(header))
+
+        tmp = "%s.tmp%d" % (filename, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                len(header)))
+            f.write(header)
+            for _, _, _, offset, arr in arrays:
+                f.seek(data_start + offset)
+                arr.tofile(f)
+        os.rename(tmp, filename)
+
+    def to_networkx(self):
+        """
+        Return this graph as a networkx graph with ``"u<id>"`` and
+        ``"m<id>"`` nodes, like the ones ``from_networkx`` takes.
+        """
+        g = nx.Graph()
+        g.add_nodes_from(("u%d" % u for u in self.users().tolist()),
+                bipartite=1)
+        g.add_nodes_from(("m%d" % m for m in self.movies().tolist()),
+                bipartite=0)
+
+        users, movies, _ = self.edges()
+        g.add_edges_from(("u%d" % u, "m%d" % m)
+                for u, m in zip(users.tolist(), movies.tolist()))
+        return g
+
+    def at_least(self, min_rating):
+        """
+        Return a view of the graph with only the edges with a rating of at
+        least ``min_rating``. It shares the storage of this graph, and can
+        use a lower threshold than this graph's if it's itself a view.
+        """
+        if self.user_ratings is None:
+            raise ValueError("this graph has no ratings")
+        return BipartiteGraph(self.user_ids, self.movie_ids,
+                self.user_ptr, self.user_idx, self.movie_ptr, self.movie_idx,
+                self.user_ratings, self.movie_ratings, min_rating=min_rating)
+
+    def users(self):
+        """Return the ids of the users"""
+        return self._users
+
+    def movies(self):
+        """Return the ids of the movies"""
+        return self._movies
+
+    def user_degrees(self):
+        """Return the number of movies of each user of ``user_ids``"""
+        return self._user_degrees
+
+    def movie_degrees(self):
+        """Return the number of fans of each movie of ``movie_ids``"""
+        return self._movie_degrees
+
+    def user_degree(self, u):
+        """Return the number of movies of the user ``u``"""
+        i = self.user_index(u)
+        return int(self._user_degrees[i]) if i >= 0 else 0
+
+    def movie_degree(self, m):
+        """Return the number of fans of the movie ``m``"""
+        i = self.movie_index(m)
+        return int(self._movie_degrees[i]) if i >= 0 else 0
+
+    def movie_popularities(self):
+        """
+        Return the popularity of each movie of ``movie_ids``, i.e. the ratio
+        of the users of the graph who are fans of it.
+        """
+        if self._movie_popularities is None:
+            n_users = max(len(self._users), 1)
+            self._movie_popularities = self._movie_degrees / float(n_users)
+        return self._movie_popularities
+
+    def movie_inverse_popularities(self):
+        """
+        Return the inverse popularity of each movie of ``movie_ids``, i.e.
+        the number of users of the graph for each fan of the movie. It's
+        infinite for movies without fans.
+        """
+        with np.errstate(divide="ignore"):
+            return 1 / self.movie_popularities()
+
+    def users_by_degree(self):
+        """
+        Return the ids of the users sorted by decreasing number of movies,
+        then by id.
+        """
+        if self._users_by_degree is None:
+            self._users_by_degree = _by_degree(self.user_ids,
+                    self._user_degrees, self._users)
+        return self._users_by_degree
+
+    def movies_by_degree(self):
+        """
+        Return the ids of the movies sorted by decreasing number of fans,
+        then by id.
+        """
+        if self._movies_by_degree is None:
+            self._movies_by_degree = _by_degree(self.movie_ids,
+                    self._movie_degrees, self._movies)
+        return self._movies_by_degree
+
+    def edges(self):
+        """
+        Return the edges as a tuple of arrays ``(users, movies, ratings)``,
+        sorted by user. ``ratings`` is ``None`` if the graph has no ratings.
+        """
+        degrees = self.user_degrees()
+        positions = expand_ranges(self.user_start, degrees)
+        users = np.repeat(self.user_ids, degrees)
+        movies = self.movie_ids[self.user_idx[positions]]
+        if self.user_ratings is None:
+            return users, movies, None
+        return users, movies, self.user_ratings[positions]
+
+    def add_edges(self, users, movies, ratings=None):
+        """
+        Return a new graph with the edges of this one plus the ones given as
+        in ``from_edges``. They must have ratings if this graph has ratings.
+        If this graph is a threshold view the new one is a view at the same
+        threshold over all the stored edges.
+
+        The new edges are inserted in the rows of this graph, which are
+        already sorted: only the rows they go in are sorted again. The arrays
+        are still copied, so this takes a time linear in the number of edges
+        of the graph, but there's no sort of all of them like in
+        ``from_edges``.
+        """
+        users = np.asarray(users, dtype=ID_DTYPE)
+        movies = np.asarray(movies, dtype=ID_DTYPE)
+        if self.user_ratings is not None:
+            ratings = np.asarray(ratings, dtype=RATING_DTYPE)
+
+        user_ids = np.union1d(self.user_ids, users)
+        movie_ids = np.union1d(self.movie_ids, movies)
+        u = np.searchsorted(user_ids, users)
+        m = np.searchsorted(movie_ids, movies)
+
+        # the stored edges with the indexes of the new nodes ids
+        user_map = np.searchsorted(user_ids, self.user_ids)
+        movie_map = np.searchsorted(movie_ids, self.movie_ids)
+        user_ptr = _remap_ptr(self.user_ptr, user_map, len(user_ids))
+        movie_ptr = _remap_ptr(self.movie_ptr, movie_map, len(movie_ids))
+        user_idx = self.user_idx
+        movie_idx = self.movie_idx
+        if len(movie_ids) > len(self.movie_ids):
+            user_idx = movie_map[user_idx].astype(ID_DTYPE)
+        if len(user_ids) > len(self.user_ids):
+            movie_idx = user_map[movie_idx].astype(ID_DTYPE)
+
+        # duplicated edges are ignored, including the ones that are already
+        # in the graph
+        n_movies = max(len(movie_ids), 1)
+        keys = u.astype(np.int64) * n_movies + m
+        keys, first = np.unique(keys, return_index=True)
+        rows = np.unique(u)
+        starts = user_ptr[rows]
+        lengths = user_ptr[rows + 1] - starts
+        stored = (np.repeat(rows, lengths).astype(np.int64) * n_movies +
+                user_idx[expand_ranges(starts, lengths)])
+        first = first[~np.in1d(keys, stored)]
+        u, m = u[first], m[first]
+        if ratings is not None:
+            ratings = ratings[first]
+
+        user_ptr, user_idx, user_ratings = _insert_entries(user_ptr,
+                user_idx, self.user_ratings, u, m, ratings)
+        movie_ptr, movie_idx, movie_ratings = _insert_entries(movie_ptr,
+                movie_idx, self.movie_ratings, m, u, ratings)
+
+        graph = BipartiteGraph(user_ids, movie_ids, user_ptr, user_idx,
+                movie_ptr, movie_idx, user_ratings, movie_ratings)
+        if self.min_rating is not None:
+            graph = graph.at_least(self.min_rating)
+        return graph
+
+    def user_index(self, u):
+        """
+        Return the index of the user ``u`` or ``-1`` if it's not in the
+        graph.
+        """
+        return _index(self.user_ids, u)
+
+    def movie_index(self, m):
+        """
+        Return the index of the movie ``m`` or ``-1`` if it's not in the
+        graph.
+        """
+        return _index(self.movie_ids, m)
+
+    def user_movies(self, u):
+        """Return the ids of the movies of the user ``u``"""
+        i = self.user_index(u)
+        if i < 0:
+            return self.movie_ids[:0]
+        return self.movie_ids[self.user_idx[self.user_start[i]:
+                                            self.user_end[i]]]
+
+    def movie_fans(self, m):
+        """Return the ids of the fans of the movie ``m``"""
+        i = self.movie_index(m)
+        if i < 0:
+            return self.user_ids[:0]
+        return self.user_ids[self.movie_idx[self.movie_start[i]:
+                                            self.movie_end[i]]]
+
+    def users_movies(self, users):
+        """
+        Return the sorted ids of the movies of at least one of the given
+        users.
+        """
+        return self.movie_ids[_neighbours(self.user_ids, self.user_start,
+            self.user_end, self.user_idx, users)]
+
+    def movies_fans(self, movies):
+        """
+        Return the sorted ids of the users who are fans of at least one of
+        the given movies.
+        """
+        return self.user_ids[_neighbours(self.movie_ids, self.movie_start,
+            self.movie_end, self.movie_idx, movies)]
+
+    def ego_nodes(self, users, distance=1, movie_mask=None,
+            max_entries=MAX_GATHER_ENTRIES):
+        """
+        Compute the ego-centered neighbourhoods of distance ``distance`` of
+        the given users ids, all at once. Distance 1 is the movies of the
+        user, distance 2 adds the fans of these movies, distance 3 adds the
+        movies of these fans, etc. If given, ``movie_mask`` is a boolean
+        array aligned with ``movie_ids``; movies where it's false are
+        ignored.
+
+        Return a list of ``(users, movies)`` sorted arrays of ids, one for
+        each given user. Unknown users have empty neighbourhoods.
+
+        Only the nodes added at the previous step are expanded, and
+        ``max_entries`` bounds the number of neighbours gathered at once.
+        """
+        users = np.asarray(users, dtype=ID_DTYPE)
+        n_egos = len(users)
+        rows, known = id_rows(self.user_ids, users)
+
+        # seen_users[e, u] is true if the user at index u is in the
+        # neighbourhood of the ego e; same for seen_movies.
+        seen_users = np.zeros((n_egos, len(self.user_ids)), dtype=bool)
+        seen_movies = np.zeros((n_egos, len(self.movie_ids)), dtype=bool)
+
+        # the frontier is given as (ego, node index) pairs
+        egos = np.flatnonzero(known)
+        nodes = rows[known].astype(np.int64)
+        seen_users[egos, nodes] = True
+
+        user_movies = (self.user_start, self.user_end, self.user_idx)
+        movie_fans = (self.movie_start, self.movie_end, self.movie_idx)
+
+        for step in range(distance):
+            # users -> movies on even steps, movies -> users on odd ones
+            if step % 2 == 0:
+                csr, seen, mask = user_movies, seen_movies, movie_mask
+            else:
+                csr, seen, mask = movie_fans, seen_users, None
+
+            new_egos = []
+            new_nodes = []
+            for e, n in _gather(egos, nodes, csr, max_entries):
+                keep = ~seen[e, n]
+                if mask is not None:
+                    keep &= mask[n]
+                e, n = e[keep], n[keep]
+                # an ego may reach a node through several others
+                keys = np.unique(e * seen.shape[1] + n)
+                e, n = keys // seen.shape[1], keys % seen.shape[1]
+                seen[e, n] = True
+                new_egos.append(e)
+                new_nodes.append(n)
+
+            if not new_egos:
+                break
+            egos = np.concatenate(new_egos)
+            nodes = np.concatenate(new_nodes)
+
+        return [(self.user_ids[seen_users[e]], self.movie_ids[seen_movies[e]])
+                for e in range(n_egos)]
+
+    def subgraph(self, users, movies):
+        """
+        Return the subgraph induced by the given users and movies ids. Ids
+        that are not in this graph are ignored. The subgraph has all the given
+        nodes, even those without edges, and isn't a threshold view.
+        """
+        users = np.intersect1d(np.asarray(users, ID_DTYPE), self.user_ids)
+        movies = np.intersect1d(np.asarray(movies, ID_DTYPE), self.movie_ids)
+
+        kept_movies = np.zeros(len(self.movie_ids), dtype=bool)
+        kept_movies[np.searchsorted(self.movie_ids, movies)] = True
+
+        # walk only the edges of the kept users
+        rows = np.searchsorted(self.user_ids, users)
+        starts = self.user_start[rows]
+        lengths = self.user_end[rows] - starts
+        positions = expand_ranges(starts, lengths)
+        idx = self.user_idx[positions]
+        edge_users = np.repeat(users, lengths)
+
+        keep = kept_movies[idx]
+        ratings = None
+        if self.user_ratings is not None:
+            ratings = self.user_ratings[positions[keep]]
+
+        return BipartiteGraph.from_edges(edge_users[keep],
+                self.movie_ids[idx[keep]], ratings, users, movies)
+
+def _aligned(offset):
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+def id_rows(ids, nodes):
+    """
+    Return the indexes of the ``nodes`` ids in the sorted ``ids`` array and a
+    boolean array telling which ones are in it.
+    """
+    rows = np.searchsorted(ids, nodes)
+    if not len(ids):
+        return rows, np.zeros(len(nodes), dtype=bool)
+    rows = np.minimum(rows, len(ids) - 1)
+    return rows, ids[rows] == nodes
+
+def _index(ids, n):
+    i = np.searchsorted(ids, n)
+    if i < len(ids) and ids[i] == n:
+        return int(i)
+    return -1
+
+def _gather(rows, nodes, csr, max_entries):
+    """
+    Yield ``(rows, neighbours)`` arrays for each ``(rows[i], nodes[i])`` pair
+    and each neighbour of ``nodes[i]`` in the ``(start, end, idx)`` CSR
+    structure ``csr``, by chunks of about ``max_entries`` pairs.
+    """
+    start, end, idx = csr
+    degrees = end[nodes] - start[nodes]
+    limits = np.cumsum(degrees)
+    i = 0
+    while i < len(nodes):
+        # take at least one node
+        j = max(i + 1, np.searchsorted(limits,
+            limits[i] - degrees[i] + max_entries, side="right"))
+        chunk_degrees = degrees[i:j]
+        neighbours = idx[expand_ranges(start[nodes[i:j]], chunk_degrees)]
+        yield (np.repeat(rows[i:j], chunk_degrees),
+                neighbours.astype(np.int64))
+        i = j
+
+def _by_degree(ids, degrees, nodes):
+    """
+    Return the ``nodes`` (a sorted subset of ``ids``) sorted by decreasing
+    degree. ``degrees`` is aligned with ``ids``.
+    """
+    degrees = degrees[np.searchsorted(ids, nodes)]
+    return nodes[np.argsort(-degrees, kind="mergesort")]
+
+def _remap_ptr(ptr, rows, n):
+    """
+    Return the CSR offsets of ``n`` rows where the row ``rows[i]`` has the
+    entries of the row ``i`` of ``ptr`` and the other ones are empty.
+    """
+    if len(rows) == n:
+        return ptr
+    lengths = np.zeros(n, dtype=PTR_DTYPE)
+    lengths[rows] = ptr[1:] - ptr[:-1]
+    new_ptr = np.zeros(n + 1, dtype=PTR_DTYPE)
+    np.cumsum(lengths, out=new_ptr[1:])
+    return new_ptr
+
+def _insert_entries(ptr, idx, ratings, rows, cols, new_ratings):
+    """
+    Return the ``(ptr, idx, ratings)`` CSR structure with the new entries
+    ``(rows[i], cols[i])`` of rating ``new_ratings[i]``. The entries of each
+    row are sorted by decreasing rating then by index, like ``from_edges``
+    does. ``ratings`` and ``new_ratings`` are ``None`` if there are no
+    ratings.
+    """
+    if not len(rows):
+        return ptr, idx, ratings
+
+    # the entries of the rows that get new ones, followed by the new ones
+    touched = np.unique(rows)
+    starts = ptr[touched]
+    lengths = ptr[touched + 1] - starts
+    positions = expand_ranges(starts, lengths)
+    n_stored = len(positions)
+
+    all_rows = np.concatenate((np.repeat(touched, lengths), rows))
+    all_cols = np.concatenate((idx[positions], cols))
+    if ratings is None:
+        all_ratings = np.zeros(len(all_rows), dtype=RATING_DTYPE)
+    else:
+        all_ratings = np.concatenate((ratings[positions], new_ratings))
+    order = np.lexsort((all_cols, -all_ratings, all_rows))
+
+    # the number of stored entries of its row before each new entry gives
+    # where it goes
+    is_new = order >= n_stored
+    stored_before = np.cumsum(~is_new) - ~is_new
+    new = order[is_new] - n_stored
+    row_offsets = np.cumsum(lengths) - lengths
+    at = (ptr[rows[new]] + stored_before[is_new] -
+            row_offsets[np.searchsorted(touched, rows[new])])
+
+    idx = np.insert(idx, at, cols[new])
+    if ratings is not None:
+        ratings = np.insert(ratings, at, new_ratings[new])
+    added = np.zeros(len(ptr), dtype=PTR_DTYPE)
+    np.cumsum(np.bincount(rows, minlength=len(ptr) - 1), out=added[1:])
+    return ptr + added, idx, ratings
+
+def prefix_ends(ptr, ratings, min_rating):
+    """
+    Return the end offsets of the rows of the CSR structure ``ptr`` when only
+    the ratings of at least ``min_rating`` are kept. ``ratings`` must be
+    sorted by decreasing order in each row.
+    """
+    kept = np.zeros(len(ratings) + 1, dtype=PTR_DTYPE)
+    np.cumsum(ratings >= min_rating, out=kept[1:])
+    return ptr[:-1] + (kept[ptr[1:]] - kept[ptr[:-1]])
+
+def _neighbours(ids, start, end, idx, nodes):
+    """
+    Return the sorted indexes of the neighbours of the given nodes ids in the
+    CSR structure ``start``/``end``/``idx`` whose rows are ``ids``. Unknown
+    ids are ignored.
+    """
+    nodes = np.intersect1d(np.asarray(nodes, dtype=ID_DTYPE), ids)
+    rows = np.searchsorted(ids, nodes)
+    starts = start[rows]
+    return np.unique(idx[expand_ranges(starts, end[rows] - starts)])
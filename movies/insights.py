@@ -1,125 +1,121 @@
 # -*- coding: UTF-8 -*-
 
-from collections import defaultdict
+import json
 
-from .analysis import RatingsGraph
+import numpy as np
 
-def minimal_movies_coverage(rg, t=0):
+from . import biclique, bitsets
+from .analysis import node_id, user_keys, movie_keys
+from .buddies import buddy_index
+from .cooccurrence import movie_pairs
+from .gatekeepers import gatekeepers_table
+from .setcover import greedy_cover, set_cover
+
+def minimal_movies_coverage(rg, t=0, exact=None, stats=False):
     """
     Return a minimal movies list such as all users in the dataset have seen at
     least one of them. ``t`` is the ratio to exclude. That is, if t=0.01, the
     returned coverage is for 99% of all users. t=0.5 returns a coverage for 50%
     of all users.
 
-    This takes ~11 minutes to run.
+    The cover is exact on small graphs and greedy on others; see
+    :func:`~movies.setcover.set_cover` for ``exact``. Pass ``stats=True`` to
+    get a ``(movies, stats)`` pair with the search statistics.
     """
-    movies = rg.movies()
-    movies.sort(key=lambda m: len(rg.movie_fans(m)), reverse=True)
-    users = set(rg.users())
-
-    p = int(len(users) * t)
-
-    def coverage(movies, users, cov):
-        if len(users) <= p:
-            return cov
-
-        if not movies:
-            # just to be sure we don't get this possibility
-            return [0]*100
-
-        m = movies[0]
-        diff_users = users.difference(rg.movie_fans(m))
-
-        made_a_diff = len(diff_users) != len(users)
-
-        cov2 = cov + [m]
-
-        without_m = coverage(movies[1:], diff_users, cov2)
-
-        if not made_a_diff:
-            return without_m
-
-        with_m = coverage(movies[1:], diff_users, cov2)
-
-        if len(with_m) < len(without_m):
-            return with_m
-        return without_m
+    movies = rg.movies_by_degree()
+    return _coverage(movies, rg.movie_fans_bitsets(movies), t, exact, stats)
 
-    return coverage(movies, users, [])
-
-
-def minimal_users_coverage(rg, t=0):
+def minimal_users_coverage(rg, t=0, exact=None, stats=False):
     """
     Return a minimal users list such as each movie from the dataset has been
-    seen by at least one user from the list.
+    seen by at least one user from the list. ``t``, ``exact`` and ``stats``
+    work like for :func:`minimal_movies_coverage`.
     """
-    # TODO factor this code with the minimal_movies_coverage above
-    users = rg.users()
-    users.sort(key=lambda m: len(rg.user_movies(m)), reverse=True)
-    movies = set(rg.movies())
-
-    p = int(len(movies) * t)
-
-    def coverage(users, movies, cov):
-        if len(movies) <= p: #not movies:
-            return cov
-
-        if not users:
-            # just to be sure we don't get this possibility
-            return [0]*100
+    users = rg.users_by_degree()
+    return _coverage(users, rg.user_movies_bitsets(users), t, exact, stats)
 
-        m = users[0]
-        diff_movies = movies.difference(rg.user_movies(m))
-
-        made_a_diff = len(diff_movies) != len(movies)
-
-        cov2 = cov + [m]
-
-        without_m = coverage(users[1:], diff_movies, cov2)
-
-        if not made_a_diff:
-            return without_m
+def greedy_movies_coverage(rg, t=0, weights=None):
+    """
+    Return a greedy movies coverage of the users: each step adds the movie
+    with the most fans among the users who aren't covered yet. ``t`` is the
+    ratio of users to exclude, like for :func:`minimal_movies_coverage`.
 
-        with_m = coverage(users[1:], diff_movies, cov2)
+    ``weights`` is an optional ``dict`` mapping movies to their weight (the
+    default is 1); the movies with the most new fans per unit of weight are
+    then picked first.
 
-        if len(with_m) < len(without_m):
-            return with_m
-        return without_m
+    The result is a list of ``(movie, fans, covered)`` tuples in the order
+    the movies are picked, where ``fans`` is the number of users the movie
+    adds to the coverage and ``covered`` the number of users covered so far.
+    """
+    movies = rg.movies()
+    return _greedy_coverage(movies, rg.movie_fans_bitsets(movies), t, weights)
 
-    return coverage(users, movies, [])
+def greedy_users_coverage(rg, t=0, weights=None):
+    """
+    Return a greedy users coverage of the movies, like
+    :func:`greedy_movies_coverage` does for movies.
+    """
+    users = rg.users()
+    return _greedy_coverage(users, rg.user_movies_bitsets(users), t, weights)
+
+def _greedy_coverage(keys, bits, t, weights):
+    sets = [bitsets.to_int(b) for b in bits]
+    n = int(bitsets.popcount(np.bitwise_or.reduce(bits, axis=0))) \
+            if len(bits) else 0
+    if weights is not None:
+        weights = [weights.get(k, 1) for k in keys]
+    cover = greedy_cover(sets, n - int(n * t), weights=weights,
+            sizes=bitsets.popcount(bits).tolist())
+    return [(keys[i], gain, covered) for i, gain, covered in cover]
+
+def _coverage(keys, bits, t, exact, with_stats):
+    """
+    Return a minimal cover of the packed bitsets ``bits`` as a list of
+    ``keys``.
+    """
+    cover, stats = set_cover([bitsets.to_int(b) for b in bits], t=t,
+            exact=exact)
+    cover = [keys[i] for i in cover]
+    return (cover, stats) if with_stats else cover
 
-def common_movies_fans(rg, t=0.1, min_fans=2):
+def max_balanced_biclique(rg, time_budget=None, stats=False):
+    """
+    Return the users and the movies of a maximum balanced biclique of the
+    graph, i.e. the largest ``N`` such that ``N`` users all liked the same
+    ``N`` movies, as a ``(users, movies)`` pair. There may be more users
+    than movies in it.
+
+    ``time_budget`` is a number of seconds after which the search stops and
+    returns the biggest biclique it found. Pass ``stats=True`` to get a
+    ``(users, movies, stats)`` tuple where ``stats["size"]`` is ``N`` and
+    ``stats["upper_bound"]`` a bound on the size of a maximum one; see
+    :func:`~movies.biclique.max_balanced_biclique`.
+    """
+    csr = rg.csr
+    users, movies, stats_ = biclique.max_balanced_biclique(csr,
+            time_budget=time_budget)
+    users = user_keys(csr.user_ids[users])
+    movies = movie_keys(csr.movie_ids[movies])
+    return (users, movies, stats_) if stats else (users, movies)
+
+def common_movies_fans(rg, t=0.1, min_fans=2, sparse=False):
     """
     Compute the common movie fans between each pair of movies. The result is a
     ratio of intersection/union, returned as a dict of dicts:
         movie -> movie -> ratio
     Ratios under ``t`` and movies with less than ``min_fans`` are removed.
-    """
-    movies = rg.movies()
-    fans = {m: set(rg.movie_fans(m)) for m in movies}
-    ratios = {}
-
-    for i, m1 in enumerate(movies):
-        f1 = fans[m1]
-        if len(f1) < min_fans:
-            continue
-
-        rs = {}
-        for m2 in movies[i+1:]:
-            f2 = fans[m2]
-            if len(f2) < min_fans:
-                continue
-            r = len(f1.intersection(f2))/float(len(f1.union(f2)))
-            if r > t:
-                rs[m2] = r
 
-        if rs:
-            ratios[m1] = rs
-
-    return ratios
+    Pass ``sparse=True`` to get a :class:`~movies.cooccurrence.MoviePairs`
+    instead. Its ``above`` method keeps the pairs above a higher ``t``
+    without computing them again, and ``to_dict`` gives the dict of dicts.
+    """
+    pairs = movie_pairs(rg, t=t, min_fans=min_fans)
+    return pairs if sparse else pairs.to_dict()
 
 def gatekeepers_distribution(rg, gatekeepers_count=1,
-        buddy_threshold=0, buddies=None, movies=False, keep_ids=False):
+        buddy_threshold=0, buddies=None, movies=False, keep_ids=False,
+        strict=True):
     """
     Return a distribution of gatekeepers as a list ``L`` of counts such that if
     ``L[N] = M`` then there are ``M`` gatekeepers in the dataset who hide
@@ -132,36 +128,86 @@ def gatekeepers_distribution(rg, gatekeepers_count=1,
 
     If ``keep_ids=True`` is passed the gatekeepers' ids are kept instead of
     their number. The distribution will then be a list of lists of gatekeepers
-    instead of a list of counts.
+    instead of a list of counts, sorted by id.
+
+    Buddies are the pairs of users with a score above ``buddy_threshold``,
+    or of at least ``buddy_threshold`` if ``strict=False``.
     """
     if buddies is None:
-        buddies = RatingsGraph.users_buddies(buddy_threshold)
-
-    users_gatekeepers = rg.users_movies_gatekeepers(
-            gatekeepers_count=gatekeepers_count,
-            buddies=buddies)
-    gatekeepers = defaultdict(set)
-
-    for u, gts in users_gatekeepers.items():
-        for gt, movies_ in gts.items():
-            if movies:
-                gatekeepers[gt].update(movies_)
-            else:
-                gatekeepers[gt].add(u)
-
-    if keep_ids:
-        distrib = defaultdict(list)
-    else:
-        distrib = defaultdict(int)
-
-    max_n = 0
-
-    for g, s in gatekeepers.items():
-        n = len(s)
-        max_n = max(n, max_n)
-        if keep_ids:
-            distrib[n].append(g)
-        else:
-            distrib[n] += 1
-
-    return [distrib[m] for m in range(0, max_n+1)]
+        buddies = buddy_index().at_least(buddy_threshold, strict=strict)
+
+    table = gatekeepers_table(rg, buddies.users(), gatekeepers_count)
+    return _gatekeepers_distribution(table, gatekeepers_count, movies=movies,
+            keep_ids=keep_ids)
+
+def gatekeepers_distributions(rg, buddy_thresholds, gatekeepers_counts,
+        movies=False, keep_ids=False, strict=True):
+    """
+    Yield the gatekeepers distribution of each buddy threshold and each
+    gatekeepers count, as ``gatekeepers_distribution`` would return it with
+    the same ``movies``, ``keep_ids`` and ``strict`` arguments. The rows are
+    ``dict`` with the keys ``buddy_threshold``, ``gt_count`` and
+    ``distribution``, in order: all the counts of the first threshold, then
+    all the counts of the second one, etc.
+
+    The gatekeepers are computed once for the highest count and the users of
+    the lowest threshold; each row is then a filter on them.
+    """
+    index = buddy_index()
+    graphs = [index.at_least(t, strict=strict) for t in buddy_thresholds]
+    users = set()
+    for buddies in graphs:
+        users.update(buddies.users())
+
+    table = gatekeepers_table(rg, users, max(gatekeepers_counts or [0]))
+
+    for buddy_threshold, buddies in zip(buddy_thresholds, graphs):
+        ids = np.array([node_id(u) for u in buddies.users()], dtype=np.int64)
+        keep = np.in1d(table[0], ids)
+        buddies_table = [column[keep] for column in table]
+
+        for gt_count in gatekeepers_counts:
+            yield {
+                "buddy_threshold": buddy_threshold,
+                "gt_count": gt_count,
+                "distribution": _gatekeepers_distribution(buddies_table,
+                    gt_count, movies=movies, keep_ids=keep_ids),
+            }
+
+def write_gatekeepers_distributions(filename, rows, verbose=False):
+    """
+    Write the rows yielded by ``gatekeepers_distributions`` in ``filename``,
+    one JSON object per line. Each row is written as soon as it's computed.
+    """
+    with open(filename, "w") as f:
+        for row in rows:
+            if verbose:
+                print "gt_count: %2d / threshold: %.4f" % (
+                        row["gt_count"], row["buddy_threshold"])
+            f.write("%s\n" % json.dumps(row))
+            f.flush()
+
+def _gatekeepers_distribution(table, gatekeepers_count, movies=False,
+        keep_ids=False):
+    """
+    Return the gatekeepers distribution of a table returned by
+    ``gatekeepers_table``, for ``gatekeepers_count``. See
+    ``gatekeepers_distribution``.
+    """
+    users, gatekeepers, movies_, counts = table
+    keep = counts <= gatekeepers_count
+    gatekeepers = gatekeepers[keep]
+    hidden = (movies_ if movies else users)[keep]
+
+    # the number of distinct users (or movies) each gatekeeper hides
+    base = hidden.max() + 1 if len(hidden) else 1
+    pairs = np.unique(gatekeepers * base + hidden)
+    gatekeepers, ns = np.unique(pairs // base, return_counts=True)
+
+    if not keep_ids:
+        return np.bincount(ns, minlength=1).tolist()
+
+    distrib = [[] for _ in range(ns.max() + 1 if len(ns) else 1)]
+    for g, n in zip(gatekeepers.tolist(), ns.tolist()):
+        distrib[n].append("u%d" % g)
+    return distrib
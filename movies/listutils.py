@@ -1,6 +1,8 @@
 #! /usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+from itertools import islice
+
 import numpy as np
 
 # copied from the cancerologues project
@@ -12,3 +14,18 @@ def correlation(l1, l2):
     0.9897782665572893
     """
     return np.corrcoef(l1, l2).tolist()[0][1]
+
+def chunks(iterable, size):
+    """
+    Lazily split an iterable in lists of at most ``size`` elements. Only one
+    chunk is held in memory at a time.
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
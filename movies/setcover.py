@@ -0,0 +1,242 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Set cover: find a few sets whose union covers all the elements of their
+union, or all of them but a given ratio.
+
+Sets are bitsets stored as Python ints: the element ``i`` is in the set ``s``
+if ``s >> i & 1``. Large inputs are solved with a lazy greedy algorithm:
+the gain of a set can only decrease as the cover grows, so the gains are kept
+in a heap and only the top one is re-evaluated before it's picked. Sets can
+have weights, in which case the gains are per unit of weight. Small
+inputs are solved exactly with a branch-and-bound search started from the
+greedy cover.
+"""
+
+import heapq
+import time
+
+__all__ = ["popcount", "set_cover", "greedy_cover"]
+
+# Inputs with at most this number of sets and elements are solved exactly by
+# default
+EXACT_MAX_SETS = 64
+EXACT_MAX_ELEMENTS = 512
+
+# Maximum number of nodes of the branch-and-bound search. The best cover
+# found so far is returned if it's reached.
+EXACT_MAX_NODES = 10**6
+
+def popcount(bits):
+    """
+    Return the number of elements of a bitset.
+
+    >>> popcount(0b1101)
+    3
+    """
+    return bin(bits).count("1")
+
+def set_cover(sets, t=0, exact=None, max_nodes=EXACT_MAX_NODES):
+    """
+    Return a cover of the union of ``sets``, a list of bitsets, as a list of
+    indexes of ``sets``. ``t`` is the ratio of the elements that may be left
+    uncovered, e.g. ``t=0.01`` gives a cover of 99% of them.
+
+    The search is exact if ``exact`` is true and greedy if it's false. The
+    default is to use an exact search only on small inputs. An exact search
+    stops after ``max_nodes`` nodes; it then returns the best cover it found.
+
+    The return value is a ``(cover, stats)`` pair where ``stats`` is a
+    ``dict`` with the search statistics: ``elements``, ``covered``,
+    ``evaluations`` (number of gains computed), ``greedy`` (the size of the
+    greedy cover), ``nodes`` and ``pruned`` (for the exact search),
+    ``optimal`` and ``seconds``.
+    """
+    start = time.time()
+
+    universe = 0
+    for s in sets:
+        universe |= s
+    n = popcount(universe)
+    slack = int(n * t)
+
+    if exact is None:
+        exact = len(sets) <= EXACT_MAX_SETS and n <= EXACT_MAX_ELEMENTS
+
+    stats = {
+        "elements": n,
+        "evaluations": 0,
+        "nodes": 0,
+        "pruned": 0,
+        "optimal": False,
+    }
+
+    cover = [i for i, _, _ in greedy_cover(sets, n - slack, stats=stats)]
+    stats["greedy"] = len(cover)
+
+    if exact:
+        cover = _BranchAndBound(sets, universe, slack, cover, stats,
+                max_nodes).search()
+
+    covered = 0
+    for i in cover:
+        covered |= sets[i]
+    stats["covered"] = popcount(covered)
+    stats["seconds"] = time.time() - start
+
+    return cover, stats
+
+def greedy_cover(sets, target=None, weights=None, sizes=None, stats=None):
+    """
+    Return a greedy cover of at least ``target`` elements (default: all) of
+    the union of ``sets``, a list of bitsets. Each step picks the set that
+    covers the most new elements, or the most new elements per unit of
+    weight if ``weights`` are given; ties go to the lowest index. Sets that
+    don't cover anything new are never picked.
+
+    The cover is returned as a list of ``(i, gain, covered)`` tuples in the
+    order the sets are picked: ``gain`` is the number of elements ``sets[i]``
+    adds and ``covered`` the number of elements covered so far. ``stats``
+    is updated with the number of gains computed, if it's given.
+
+    ``sizes`` are the sizes of the sets, if they're already known. They're
+    their first gains.
+    """
+    uncovered = 0
+    for s in sets:
+        uncovered |= s
+    if target is None:
+        target = popcount(uncovered)
+    if stats is None:
+        stats = {}
+    stats.setdefault("evaluations", 0)
+
+    def key(i, gain):
+        if weights is None:
+            return (-gain, i)
+        return (-gain / float(weights[i]), i)
+
+    if sizes is None:
+        sizes = [popcount(s) for s in sets]
+        stats["evaluations"] += len(sets)
+    heap = [key(i, size) for i, size in enumerate(sizes)]
+    heapq.heapify(heap)
+
+    cover = []
+    covered = 0
+    while covered < target and heap:
+        _, i = heapq.heappop(heap)
+        gain = popcount(sets[i] & uncovered)
+        stats["evaluations"] += 1
+
+        if not gain:
+            continue
+        # its gain went down, it may not be the best one anymore
+        if heap and key(i, gain) > heap[0]:
+            heapq.heappush(heap, key(i, gain))
+            continue
+
+        uncovered &= ~sets[i]
+        covered += gain
+        cover.append((i, gain, covered))
+
+    return cover
+
+class _BranchAndBound(object):
+    """
+    Exact search of a minimal cover. At each node we take the uncovered
+    element that is in the fewest sets and branch on each one of these sets;
+    if some elements may stay uncovered, a last branch leaves it uncovered.
+
+    A branch is pruned if it can't give a cover smaller than the best one:
+    the number of sets it still needs is at least the number of the biggest
+    gains needed to cover enough elements.
+    """
+
+    def __init__(self, sets, universe, slack, best, stats, max_nodes):
+        self.sets = sets
+        self.slack = slack
+        self.best = list(best)
+        self.stats = stats
+        self.max_nodes = max_nodes
+
+        # the indexes of the sets each element is in
+        self.element_sets = {}
+        for i, s in enumerate(sets):
+            for e in _elements(s):
+                self.element_sets.setdefault(e, []).append(i)
+
+        self.universe = universe
+
+    def search(self):
+        self.stats["optimal"] = True
+        self._search(self.universe, range(len(self.sets)), [], self.slack)
+        return self.best
+
+    def _search(self, uncovered, available, chosen, slack):
+        if self.stats["nodes"] >= self.max_nodes:
+            self.stats["optimal"] = False
+            return
+        self.stats["nodes"] += 1
+
+        remaining = popcount(uncovered)
+        if remaining <= slack:
+            if len(chosen) < len(self.best):
+                self.best = list(chosen)
+            return
+
+        gains = {i: popcount(self.sets[i] & uncovered) for i in available}
+        if self._lower_bound(gains, remaining - slack) + len(chosen) >= \
+                len(self.best):
+            self.stats["pruned"] += 1
+            return
+
+        available = set(i for i in available if gains[i])
+        e, e_sets = self._branching_element(uncovered, available)
+
+        e_sets.sort(key=lambda i: -gains[i])
+        for i in e_sets:
+            chosen.append(i)
+            available.discard(i)
+            self._search(uncovered & ~self.sets[i], available, chosen, slack)
+            chosen.pop()
+
+        if slack:
+            # e stays uncovered; all its sets were tried above
+            self._search(uncovered & ~(1 << e), available, chosen, slack - 1)
+
+    def _branching_element(self, uncovered, available):
+        """
+        Return the uncovered element that is in the fewest available sets
+        and the list of these sets.
+        """
+        best = None
+        for e in _elements(uncovered):
+            e_sets = [i for i in self.element_sets[e] if i in available]
+            if best is None or len(e_sets) < len(best[1]):
+                best = (e, e_sets)
+                if len(e_sets) <= 1:
+                    break
+        return best
+
+    @staticmethod
+    def _lower_bound(gains, needed):
+        """
+        Return the minimal number of sets with the given gains needed to
+        cover ``needed`` elements, or an infinite bound if they can't.
+        """
+        total = 0
+        for k, gain in enumerate(sorted(gains.values(), reverse=True)):
+            if total >= needed:
+                return k
+            total += gain
+        return len(gains) if total >= needed else float("inf")
+
+def _elements(bits):
+    """
+    Yield the indexes of the elements of a bitset, from the lowest one.
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
@@ -0,0 +1,203 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Users similarities computed from their positive ratings.
+
+The users x movies incidence structure is the CSR representation of the
+ratings graph: two pairs of NumPy arrays (offsets and neighbours, in both
+directions). The intersections between users' movies are then computed for
+blocks of users at a time, which keeps the memory usage bounded whatever the
+number of users.
+"""
+
+from collections import Counter
+
+import numpy as np
+
+from .graph import expand_ranges
+
+__all__ = ["Incidence", "user_similarities", "user_pairs", "user_pairs_of"]
+
+# Maximum number of (user, user) entries computed at once. Each entry uses a
+# few int64 so the default uses a few hundred MBs at most.
+MAX_BLOCK_ENTRIES = 2**23
+
+class Incidence(object):
+    """
+    A sparse users x movies incidence structure. ``user_start``/``user_end``/
+    ``user_idx`` give the movies indexes of each user: the movies of the user
+    ``i`` are ``user_idx[user_start[i]:user_end[i]]``.
+    ``movie_start``/``movie_end``/``movie_idx`` are the same for the fans of
+    each movie.
+    """
+
+    def __init__(self, rg):
+        csr = rg.csr
+        # all the users rows, including those without movies if the graph is
+        # a threshold view
+        self.users = ["u%d" % u for u in csr.user_ids.tolist()]
+        self.movies = ["m%d" % m for m in csr.movie_ids.tolist()]
+        self.user_index = {u: i for i, u in enumerate(self.users)}
+        # integer ids of the users, e.g. 42 for "u42"
+        self.user_ids = csr.user_ids.astype(np.int64)
+
+        self.user_start = csr.user_start
+        self.user_end = csr.user_end
+        self.user_idx = csr.user_idx
+        self.movie_start = csr.movie_start
+        self.movie_end = csr.movie_end
+        self.movie_idx = csr.movie_idx
+
+    def user_degrees(self):
+        return self.user_end - self.user_start
+
+    def movie_degrees(self):
+        return self.movie_end - self.movie_start
+
+    def co_fans(self, block):
+        """
+        Return a ``len(block) x len(self.users)`` matrix where ``M[i, j]`` is
+        the number of movies both ``block[i]`` and the user ``j`` liked.
+        ``block`` is an array of users indexes.
+        """
+        n_users = len(self.users)
+
+        # movies of each user of the block, and the local index of the user
+        starts, ends = self.user_start[block], self.user_end[block]
+        lengths = ends - starts
+        movies = self.user_idx[expand_ranges(starts, lengths)]
+        rows = np.repeat(np.arange(len(block)), lengths)
+
+        # fans of each one of these movies
+        starts = self.movie_start[movies]
+        lengths = self.movie_end[movies] - starts
+        fans = self.movie_idx[expand_ranges(starts, lengths)]
+        rows = np.repeat(rows, lengths)
+
+        counts = np.bincount(rows * n_users + fans,
+                minlength=len(block) * n_users)
+        return counts.reshape((len(block), n_users))
+
+def blocks(costs, width, max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Split ``range(len(costs))`` in consecutive blocks such that for each
+    block both the sum of the costs and ``len(block) * width`` stay under
+    ``max_entries``, unless a single item is already above.
+    """
+    block = []
+    block_cost = 0
+    for i, cost in enumerate(costs):
+        if block and (block_cost + cost > max_entries or
+                (len(block) + 1) * width > max_entries):
+            yield np.array(block, dtype=np.int64)
+            block = []
+            block_cost = 0
+        block.append(i)
+        block_cost += cost
+
+    if block:
+        yield np.array(block, dtype=np.int64)
+
+def _similarities(inc, users, min_score, max_entries):
+    """
+    Yield ``(u, others, common, scores)`` for each user index of ``users``,
+    where ``others`` are the indexes of the other users who liked at least one
+    movie in common with ``u``, ``common`` the number of such movies and
+    ``scores`` the Jaccard indexes. Only scores of at least ``min_score`` are
+    kept.
+    """
+    user_degrees = inc.user_degrees()
+    movie_degrees = inc.movie_degrees()
+
+    # the number of entries of the fans expansion for each user
+    costs = np.zeros(len(users), dtype=np.int64)
+    for i, u in enumerate(users):
+        ms = inc.user_idx[inc.user_start[u]:inc.user_end[u]]
+        costs[i] = movie_degrees[ms].sum()
+
+    for block in blocks(costs, len(inc.users), max_entries):
+        block = users[block]
+        counts = inc.co_fans(block)
+        for i, u in enumerate(block):
+            row = counts[i]
+            row[u] = 0
+            others = np.flatnonzero(row)
+            common = row[others]
+            union = user_degrees[u] + user_degrees[others] - common
+            scores = common / union.astype(np.float64)
+
+            keep = scores >= min_score
+            yield u, others[keep], common[keep], scores[keep]
+
+def user_similarities(rg, u_ids=None, min_score=0,
+        max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Yield ``(u_id, buddies)`` pairs for each user of ``u_ids`` (default: all
+    the users of the graph), in order. ``buddies`` is a ``dict`` mapping each
+    other user who liked at least one movie in common with ``u_id`` to a
+    ``dict`` with their Jaccard index (``j``) and their common movies count
+    (``c``). Pairs with a Jaccard index under ``min_score`` are dropped.
+
+    ``max_entries`` bounds the size of the intermediary arrays.
+    """
+    inc = Incidence(rg)
+    if u_ids is None:
+        u_ids = rg.users()
+
+    # users that are in the graph, in the requested order
+    known = np.array([inc.user_index[u] for u in u_ids if u in inc.user_index],
+            dtype=np.int64)
+
+    sims = _similarities(inc, known, min_score, max_entries)
+    for u_id in u_ids:
+        if u_id in inc.user_index:
+            _, others, common, scores = next(sims)
+            yield u_id, {inc.users[v]: dict(j=float(s), c=int(c))
+                    for v, s, c in zip(others, scores, common)}
+        else:
+            yield u_id, {}
+
+def user_pairs(rg, min_score=0, max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Yield a ``(user1, user2, score, count)`` tuple for each unordered pair of
+    users who liked at least one movie in common, with ``user1 < user2``.
+    Users are given by their integer ids; ``score`` is the Jaccard index of
+    their movies and ``count`` the number of movies in common. Pairs with a
+    score under ``min_score`` are dropped.
+    """
+    inc = Incidence(rg)
+    users = np.arange(len(inc.users), dtype=np.int64)
+
+    for u, others, common, scores in _similarities(inc, users, min_score,
+            max_entries):
+        u_id = int(inc.user_ids[u])
+        ids = inc.user_ids[others]
+        keep = ids > u_id
+        for v_id, score, count in zip(ids[keep].tolist(),
+                scores[keep].tolist(), common[keep].tolist()):
+            yield u_id, v_id, score, count
+
+def user_pairs_of(rg, u_ids, min_score=0):
+    """
+    Like ``user_pairs`` but only for the pairs that involve at least one of
+    the given users. This walks the graph around these users instead of
+    building the whole incidence structure, so it's faster for a few users,
+    e.g. to update the links after some new ratings.
+    """
+    u_ids = set(u_ids)
+    for u_id in sorted(u_ids, key=lambda u: int(u[1:])):
+        u = int(u_id[1:])
+        movies = rg.user_movies(u_id)
+        common = Counter(fan for m in movies for fan in rg.movie_fans(m))
+        common.pop(u_id, None)
+
+        for v_id, count in common.items():
+            v = int(v_id[1:])
+            # we already yielded this pair
+            if v_id in u_ids and v < u:
+                continue
+
+            union = len(movies) + len(rg.user_movies(v_id)) - count
+            score = count / float(union)
+            if score >= min_score:
+                yield min(u, v), max(u, v), score, count
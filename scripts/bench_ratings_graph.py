@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmark the construction of the ratings graph from the DB: build time and
+peak RSS of the former networkx-based constructor vs. the current one.
+
+Usage: ::
+
+    python scripts/bench_ratings_graph.py [<movies.db> ...]
+
+Pass e.g. the path of a DB with ml-100k and the path of another one with
+ml-1m; the files must be named ``movies.db``. The default is the one of the
+current directory. Each build runs in its own process so that the peak RSS
+of one doesn't hide the other.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath('%s/..' % os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+BUILDERS = ("networkx", "csr")
+
+def build_networkx():
+    """
+    Build the graph like ``RatingsGraph`` did before it used CSR arrays
+    """
+    import networkx as nx
+    from movies.analysis import POSITIVE_RATING
+    from movies.db import Rating
+
+    g = nx.Graph()
+    for r in Rating.select().where(Rating.rating>=POSITIVE_RATING):
+        u_id = "u%d" % r.user_id
+        m_id = "m%d" % r.movie_id
+
+        g.add_node(u_id, bipartite=1)
+        g.add_node(m_id, bipartite=0)
+        g.add_edge(u_id, m_id)
+    return g.number_of_edges()
+
+def build_csr():
+    from movies.analysis import RatingsGraph
+    return RatingsGraph().csr.user_degrees().sum()
+
+def max_rss():
+    """Return the peak RSS of the current process in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss / 1024.0
+
+def measure(builder):
+    """
+    Build the graph in the current process and print the number of edges,
+    the build time, the peak RSS and the peak RSS before the build.
+    """
+    from movies.db import init_db
+    init_db()
+
+    rss = max_rss()
+    start = time.time()
+    edges = globals()["build_%s" % builder]()
+    elapsed = time.time() - start
+    print edges, elapsed, max_rss(), rss
+
+def run(dbs):
+    print "%-30s %-9s %9s %9s %11s %11s" % (
+            "DB", "builder", "edges", "time (s)", "peak (MB)", "build (MB)")
+
+    for db in dbs:
+        directory = os.path.dirname(os.path.abspath(db))
+        for builder in BUILDERS:
+            out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__),
+                        "--measure", builder],
+                    cwd=directory)
+            edges, elapsed, peak, before = out.split()
+            print "%-30s %-9s %9s %9.2f %11.1f %11.1f" % (db, builder, edges,
+                    float(elapsed), float(peak), float(peak) - float(before))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--measure":
+        measure(sys.argv[2])
+    else:
+        run(sys.argv[1:] or ["movies.db"])
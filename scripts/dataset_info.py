@@ -12,5 +12,5 @@ from movies.analysis import global_ratings_graph
 
 rg = global_ratings_graph()
 
-print "Movies: %d" % len(rg.movies())
-print "Users: %d" % len(rg.users())
+print "Movies: %d" % rg.movie_count()
+print "Users: %d" % rg.user_count()
@@ -5,26 +5,21 @@
 
 import os
 import sys
-import itertools
 sys.path.insert(0, '%s/..' % os.path.dirname(__file__))
 
 from movies.analysis import RatingsGraph
+from movies import insights
 
-def common_fans_size(m_ids):
-    return len(rg.movies_fans(m_ids))
+# seconds
+TIME_BUDGET = 600
 
 rg = RatingsGraph()
 
-N = 0
+users, movies, stats = insights.max_balanced_biclique(rg,
+        time_budget=TIME_BUDGET, stats=True)
 
-movies = rg.movies()
-
-# TODO optimize
-for m in range(3, len(movies)):
-    for movies_set in itertools.combinations(movies, m):
-        n = common_fans_size(movies_set)
-
-        if n == m and n > N:
-            N = n
-            print "N=%d" % N
-            break
+print "N=%d" % stats["size"]
+if not stats["optimal"]:
+    print "Stopped after %ds, N<=%d" % (TIME_BUDGET, stats["upper_bound"])
+print "Users: %s" % " ".join(users)
+print "Movies: %s" % " ".join(movies)
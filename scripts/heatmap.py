@@ -11,10 +11,10 @@ from movies.plotting import plt
 from movies.db import Movie
 
 rg = RatingsGraph()
-cc = insights.common_movies_fans(rg, 0.5, 10)
+pairs = insights.common_movies_fans(rg, 0, 10, sparse=True)
 
-# cc above can be computed from this, if that's necessary
-complete_cc = insights.common_movies_fans(rg, 0, 10)
+cc = pairs.above(0.5).to_dict()
+complete_cc = pairs.to_dict()
 
 fontsize = 7
 movies = set()
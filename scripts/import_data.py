@@ -3,21 +3,46 @@
 
 import os
 import sys
+import argparse
 
 sys.path.insert(0, '%s/..' % os.path.dirname(__file__))
 
 from movies.data_import import import_data
 
+parser = argparse.ArgumentParser()
+parser.add_argument("directory", nargs="?")
+parser.add_argument("format", nargs="?")
+parser.add_argument("--workers", "-w", type=int, default=1, metavar="N",
+        help="parse the dataset files using N processes")
+parser.add_argument("--bulk", action="store_true",
+        help="use fast but non-durable SQLite settings during the import")
+parser.add_argument("--links-min-score", type=float, default=0,
+        metavar="SCORE",
+        help="store only the user links with at least this score")
+parser.add_argument("--check", action="store_true",
+        help="check the cached ratings values against the ratings (slow)")
+args = parser.parse_args()
+
 directory = "./data"
 
-if len(sys.argv) == 3:
-    directory = sys.argv[1]
-    fmt = sys.argv[2]
+if args.format is not None:
+    directory = args.directory
+    fmt = args.format
 else:
-    print "Usage:\n\t%s [<directory> <format>]\n" % sys.argv[0]
+    print "Usage:\n\t%s [<directory> <format>] [options]\n" % sys.argv[0]
     print "Using directory='./data' and format='ml-100k'"
     fmt = "ml-100k"
 
 print "Importing data from '%s' using format '%s'" % (directory, fmt)
 
-import_data(directory, fmt, verbose=True)
+mismatches = import_data(directory, fmt, verbose=True, workers=args.workers,
+        bulk=args.bulk, links_min_score=args.links_min_score,
+        check=args.check)
+
+if mismatches:
+    for obj, field, expected, actual in mismatches:
+        print "%s %d: %s is %r, expected %r" % (obj.__class__.__name__,
+                obj.get_id(), field, actual, expected)
+    sys.exit(1)
+elif args.check:
+    print "Post-import values checked."
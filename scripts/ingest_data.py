@@ -0,0 +1,27 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, '%s/..' % os.path.dirname(__file__))
+
+from movies.data_import import ingest_data
+
+parser = argparse.ArgumentParser(
+        description="Add new data to an already-imported dataset")
+parser.add_argument("format")
+parser.add_argument("--movies", metavar="FILE")
+parser.add_argument("--users", metavar="FILE")
+parser.add_argument("--ratings", metavar="FILE")
+parser.add_argument("--links-min-score", type=float, metavar="SCORE",
+        help="store only the user links with at least this score (default:"
+        " the one used for the import)")
+args = parser.parse_args()
+
+print "Ingesting data using format '%s'" % args.format
+
+ingest_data(args.format, movies=args.movies, users=args.users,
+        ratings=args.ratings, verbose=True,
+        links_min_score=args.links_min_score)
@@ -18,18 +18,10 @@ rg = RatingsGraph()
 
 def run():
     # sort users by their number of watched movies
-    user_ranks = sorted(
-            [(u, len(rg.user_movies(u))) for u in rg.users()],
-            key=lambda p: p[1],
-            reverse=True)
-    users = [u for u, _ in user_ranks]
+    users = rg.users_by_degree()
 
     # sort movies by their number of watchers
-    movie_ranks = sorted(
-            [(m, len(rg.movie_fans(m))) for m in rg.movies()],
-            key=lambda p: p[1],
-            reverse=True)
-    movies = [m for m, _ in movie_ranks]
+    movies = rg.movies_by_degree()
 
     matrix = np.zeros((len(users), len(movies)))
 
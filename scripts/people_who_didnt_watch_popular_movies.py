@@ -4,32 +4,37 @@ import os
 import sys
 sys.path.insert(0, '%s/..' % os.path.dirname(__file__))
 
+import numpy as np
+
+from movies import bitsets
 from movies.analysis import global_ratings_graph
 
 rg = global_ratings_graph()
 
-movies = [(m, len(rg.movie_fans(m))) for m in rg.movies()]
-movies.sort(key=lambda p: p[1], reverse=True)
+movies = rg.movies_by_degree()
+fans = rg.movie_fans_bitsets(movies)
 
-users = set(rg.users())
+users = rg.users_bitset(rg.users())
+n_users = bitsets.popcount(users)
 # people who haven't seen all movies (in the current set)
-people = set()
+people = np.zeros_like(users)
 # people who haven't seen any movie (in the current set)
-hipsters = set(users)
+hipsters = users.copy()
 
 limit_printed = False
 
 # For each movie from the most watched to the least watched update the `people`
 # set with the users who haven't seen it and print the current length
 # We stop when all users are in the set.
-for i, (movie, _) in enumerate(movies):
-    haventseen = users.difference(rg.movie_fans(movie))
-    people.update(haventseen)
-    hipsters.intersection_update(haventseen)
+for i, movie in enumerate(movies):
+    haventseen = bitsets.difference(users, fans[i])
+    people |= haventseen
+    hipsters &= haventseen
+    n_hipsters = bitsets.popcount(hipsters)
     print "Movie %2d: %3d people missed >=1, %3d people haven't seen any" % (
-            i, len(people), len(hipsters))
-    if len(people) == len(users) and not limit_printed:
+            i, bitsets.popcount(people), n_hipsters)
+    if bitsets.popcount(people) == n_users and not limit_printed:
         print "-------------------"
         limit_printed = True
-    if not hipsters:
+    if not n_hipsters:
         break